@@ -19,42 +19,1119 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import exceptions, sys, string, os, gzip, types
+import exceptions, sys, string, os, gzip, types, array, mmap, binascii, struct, bisect, time, zlib
+import itertools, json, io
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class UEFfile_error(exceptions.Exception):
 
-    pass
+    pass
+
+# Determine the platform on which the program is running
+
+sep = os.sep
+
+if sys.platform == 'RISCOS':
+    suffix = '/'
+else:
+    suffix = '.'
+
+version = '0.20'
+date = '2010-10-24'
+
+# Block header fields following the file name: load and execution addresses,
+# block number, block length, block flag, next address and an unused word
+header_struct = struct.Struct('<IIHHBHH')
+
+# Chunk header: chunk ID and data length
+chunk_header_struct = struct.Struct('<HI')
+
+# Carrier tones before the first block of a file and before other blocks
+long_gap = struct.pack('<H', 0x00f0)
+short_gap = struct.pack('<H', 0x0078)
+
+# The shortest gaps and carrier tones left by UEFfile.shorten_gaps, in cycles
+# at twice the base frequency (2400 per second at 1200 baud). No silence is
+# needed before a file, but the 0x258 cycles (a quarter of a second) of tone
+# before its first block give a loader time to finish with the previous file
+# and request the next one before the header of the file starts to play.
+# Other blocks only need the 0x78 cycles of tone that create_chunks puts
+# before them for the filing system to lock onto the carrier again.
+min_file_gap = 0
+min_file_tone = 0x0258
+min_block_tone = 0x0078
+
+# Formats of the values held in timing chunks: carrier tones and integer gaps
+# in cycles at twice the base frequency, the base frequency in Hz, gaps in
+# seconds and the baud rate of the data encoding
+timing_structs = {0x110: struct.Struct('<H'), 0x112: struct.Struct('<H'),
+                  0x113: struct.Struct('<f'), 0x116: struct.Struct('<f'),
+                  0x117: struct.Struct('<H')}
+
+
+class ChunkTable:
+    """table = ChunkTable(source, mapped)
+
+    Create a sequence of chunks whose data is read on demand from the open
+    file object, source. Only the ID, offset and length of each chunk are
+    held in memory. Each item in the sequence is a (chunk ID, data) tuple,
+    as in the list of chunks held by a UEFfile instance.
+
+    If mapped is True then source must be a memory-mapped file or a string
+    and the data of each chunk is a buffer object referring to it instead
+    of a copy of part of it.
+    """
+
+    def __init__(self, source, mapped = False):
+
+        self.source = source
+        self.mapped = mapped
+
+        # The number of times the table has been modified
+        self.changes = 0
+
+        # Chunk IDs, data offsets and data lengths
+        self.ids = array.array('H')
+        self.offsets = array.array('L')
+        self.lengths = array.array('L')
+
+
+    def add_headers(self, ids, lengths, offset):
+        """Add chunks with the IDs and lengths given, whose headers are
+        stored one after another from the offset specified in the source
+        file."""
+
+        for i in range(len(ids)):
+
+            self.ids.append(ids[i])
+            self.offsets.append(offset + 6)
+            self.lengths.append(lengths[i])
+
+            offset = offset + 6 + lengths[i]
+
+
+    def read_headers(self, offset = 0):
+        """Read the chunk headers from the current position in the source
+        file to the end of the file, skipping over the chunk data. For a
+        mapped source, the headers are read from the offset given."""
+
+        if self.mapped:
+
+            unpack_from = struct.unpack_from
+            size = len(self.source)
+
+            while offset + 6 <= size:
+
+                chunk_id, length = unpack_from('<HI', self.source, offset)
+
+                self.ids.append(chunk_id)
+                self.offsets.append(offset + 6)
+                self.lengths.append(length)
+
+                offset = offset + 6 + length
+
+            return
+
+        while 1:
+
+            # Read the chunk ID and length
+            header = self.source.read(6)
+            if len(header) < 6:
+                break
+
+            chunk_id = ord(header[0]) | (ord(header[1]) << 8)
+            length = ord(header[2]) | (ord(header[3]) << 8) | \
+                     (ord(header[4]) << 16) | (ord(header[5]) << 24)
+
+            self.ids.append(chunk_id)
+            self.offsets.append(self.source.tell())
+            self.lengths.append(length)
+
+            # Skip the chunk data
+            self.source.seek(length, 1)
+
+
+    def size(self):
+        """Return the number of bytes occupied by the chunks in the file,
+        including their headers."""
+
+        return 6 * len(self.ids) + sum(self.lengths)
+
+
+    def close(self):
+        """Close the source file, if there is one."""
+
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+    def read_data(self, i, limit = None):
+        """Return the data for the chunk at the position given, or no more
+        than limit bytes from the start of it if limit is given."""
+
+        length = self.lengths[i]
+        if limit != None:
+            length = min(length, limit)
+
+        if length == 0:
+            return ''
+
+        if self.mapped:
+            return buffer(self.source, self.offsets[i], length)
+
+        self.source.seek(self.offsets[i])
+        return self.source.read(length)
+
+
+    def __len__(self):
+
+        return len(self.ids)
+
+
+    def __getitem__(self, i):
+
+        if type(i) == types.SliceType:
+            return map(self.__getitem__, apply(range, i.indices(len(self.ids))))
+
+        if i < 0:
+            i = i + len(self.ids)
+        if i < 0 or i >= len(self.ids):
+            raise IndexError, 'chunk index out of range'
+
+        return (self.ids[i], self.read_data(i))
+
+
+    def __delitem__(self, i):
+
+        del self.ids[i]
+        del self.offsets[i]
+        del self.lengths[i]
+        self.changes = self.changes + 1
+
+
+    def __iter__(self):
+
+        for i in range(len(self.ids)):
+            yield (self.ids[i], self.read_data(i))
+
+
+    def __add__(self, other):
+
+        return self[:] + list(other)
+
+
+    def __radd__(self, other):
+
+        return list(other) + self[:]
+
+
+class ChunkList(list):
+    """chunks = ChunkList(sequence)
+
+    Create a list of (chunk ID, data) tuples which counts the number of times
+    it is modified in its changes attribute, allowing a UEFfile instance to
+    detect when its chunk index needs to be rebuilt.
+    """
+
+    changes = 0
+
+    def changed(self):
+
+        self.changes = self.changes + 1
+
+
+    def __setitem__(self, i, value):
+
+        list.__setitem__(self, i, value)
+        self.changed()
+
+
+    def __delitem__(self, i):
+
+        list.__delitem__(self, i)
+        self.changed()
+
+
+    def __setslice__(self, i, j, sequence):
+
+        list.__setslice__(self, i, j, sequence)
+        self.changed()
+
+
+    def __delslice__(self, i, j):
+
+        list.__delslice__(self, i, j)
+        self.changed()
+
+
+    def __iadd__(self, other):
+
+        list.extend(self, other)
+        self.changed()
+        return self
+
+
+    def __imul__(self, n):
+
+        list.__imul__(self, n)
+        self.changed()
+        return self
+
+
+    def append(self, item):
+
+        list.append(self, item)
+        self.changed()
+
+
+    def extend(self, sequence):
+
+        list.extend(self, sequence)
+        self.changed()
+
+
+    def insert(self, i, item):
+
+        list.insert(self, i, item)
+        self.changed()
+
+
+    def pop(self, *args):
+
+        item = list.pop(self, *args)
+        self.changed()
+        return item
+
+
+    def remove(self, item):
+
+        list.remove(self, item)
+        self.changed()
+
+
+    def reverse(self):
+
+        list.reverse(self)
+        self.changed()
+
+
+    def sort(self, *args, **kwargs):
+
+        list.sort(self, *args, **kwargs)
+        self.changed()
+
+
+def compress_block(data, compresslevel, last):
+    """Compress a block of data as a raw deflate stream which can be joined
+    to the streams of the blocks before and after it. Only the last block
+    in a stream is terminated."""
+
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    output = compressor.compress(data)
+
+    if last:
+        return output + compressor.flush(zlib.Z_FINISH)
+    else:
+        # Align the output to a byte boundary without ending the stream
+        return output + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+class ParallelGzipFile:
+    """file = ParallelGzipFile(filename, compresslevel, threads, block_size,
+                               points)
+
+    Create a gzip file with the specified filename, to which data can be
+    written. The data is divided into blocks of block_size bytes which are
+    compressed independently by a pool with the given number of threads
+    and joined to form a single gzip member.
+
+    Since each block can be decompressed without the ones before it, the
+    start of each block is a restart point for decompression. The points
+    attribute holds a list of (compressed offset, uncompressed offset, CRC)
+    tuples for these, where the CRC is that of the data before the point.
+
+    If a list of restart points is given then the existing file is opened
+    and the data after the last of these points is replaced by the data
+    written, leaving the data before it in place.
+    """
+
+    def __init__(self, filename, compresslevel = 9, threads = None,
+                 block_size = 1048576, points = None):
+
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        if threads == None:
+            threads = cpu_count()
+
+        self.pool = ThreadPool(threads)
+
+        # Limit the number of blocks waiting to be written
+        self.limit = 2 * threads
+        self.pending = []
+
+        self.pieces = []
+        self.buffered = 0
+        self.crc = zlib.crc32('')
+        self.size = 0
+
+        if points:
+
+            # Discard the data after the last restart point and continue
+            # the stream from there
+            self.compressed, self.size, self.crc = points[-1][:3]
+            self.points = map(lambda point: point[:3], points[:-1])
+
+            self.file = open(filename, 'r+b')
+            self.file.seek(self.compressed)
+            self.file.truncate()
+            return
+
+        self.file = open(filename, 'wb')
+        self.points = []
+        self.compressed = 10
+
+        # Write the gzip header without a file name
+        if compresslevel == 9:
+            extra_flags = 2
+        elif compresslevel == 1:
+            extra_flags = 4
+        else:
+            extra_flags = 0
+
+        self.file.write('\037\213\010\000' + struct.pack('<I', int(time.time())) +
+                        chr(extra_flags) + '\377')
+
+
+    def write(self, data):
+        """Write a string or buffer to the file."""
+
+        self.pieces.append(str(data))
+        self.buffered = self.buffered + len(data)
+
+        if self.buffered >= self.block_size:
+
+            data = ''.join(self.pieces)
+            end = len(data) - (len(data) % self.block_size)
+
+            for i in range(0, end, self.block_size):
+                self.compress(data[i:i+self.block_size], False)
+
+            self.pieces = [data[end:]]
+            self.buffered = len(data) - end
+
+
+    def compress(self, data, last):
+        """Start compressing a block of data, writing completed blocks to
+        the file when too many are waiting to be written."""
+
+        result = self.pool.apply_async(compress_block,
+                                       (data, self.compresslevel, last))
+        self.pending.append((result, self.size, self.crc))
+
+        self.crc = zlib.crc32(data, self.crc)
+        self.size = self.size + len(data)
+
+        while len(self.pending) > self.limit:
+            self.write_block(*self.pending.pop(0))
+
+
+    def write_block(self, result, offset, crc):
+        """Write a compressed block to the file, recording its position as
+        a restart point."""
+
+        data = result.get()
+        self.points.append((self.compressed, offset, crc & 0xffffffff))
+        self.file.write(data)
+        self.compressed = self.compressed + len(data)
+
+
+    def close(self):
+        """Compress and write the remaining data and close the file."""
+
+        try:
+            self.compress(''.join(self.pieces), True)
+            self.pieces = []
+
+            for result, offset, crc in self.pending:
+                self.write_block(result, offset, crc)
+
+            self.pending = []
+
+            # Write the CRC and length of the uncompressed data
+            self.file.write(struct.pack('<II', self.crc & 0xffffffff,
+                                        self.size & 0xffffffff))
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.file.close()
+
+
+class IndexedGzipFile:
+    """file = IndexedGzipFile(filename, points)
+
+    Open a gzip file for reading, using a list of restart points, as
+    recorded by ParallelGzipFile, to seek to any position in the data
+    without decompressing all the data before it.
+    """
+
+    def __init__(self, filename, points):
+
+        self.file = open(filename, 'rb')
+        self.points = points
+        self.starts = map(lambda point: point[1], points)
+
+        self.position = 0
+
+        # Decompressed data starting at an offset in the uncompressed data
+        self.decompressor = None
+        self.buffer = ''
+        self.offset = 0
+
+
+    def seek(self, offset, whence = 0):
+
+        if whence == 1:
+            offset = self.position + offset
+        elif whence == 2:
+            raise IOError, 'Cannot seek relative to the end of a gzip file.'
+
+        self.position = offset
+
+
+    def tell(self):
+
+        return self.position
+
+
+    def read(self, size):
+
+        # Find the last restart point before the current position
+        i = bisect.bisect_right(self.starts, self.position) - 1
+
+        if self.decompressor == None or self.position < self.offset or \
+           self.starts[i] > self.offset + len(self.buffer):
+
+            # Decompress from the restart point instead of the current
+            # offset in the data
+            compressed, self.offset = self.points[i][:2]
+            self.file.seek(compressed)
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.buffer = ''
+
+        end = self.position + size
+
+        while self.offset + len(self.buffer) < end:
+
+            # Discard data before the current position
+            skip = min(self.position - self.offset, len(self.buffer))
+            if skip > 0:
+                self.buffer = self.buffer[skip:]
+                self.offset = self.offset + skip
+
+            compressed = self.file.read(65536)
+            if not compressed:
+                break
+
+            self.buffer = self.buffer + self.decompressor.decompress(compressed)
+
+        start = self.position - self.offset
+        data = self.buffer[start:start + size]
+        self.position = self.position + len(data)
+
+        return data
+
+
+    def close(self):
+
+        self.file.close()
+
+
+class Profile:
+    """profile = Profile()
+
+    Record the wall time, number of calls and number of bytes processed for
+    each phase of the work done by UEFfile instances given this profile.
+    The phases recorded are:
+
+        read        reading an uncompressed file
+        decompress  reading and decompressing a compressed file
+        parse       decoding the chunk headers and the UEF file information
+        contents    finding the files in the chunks
+        crc         calculating and checking block CRCs
+        write       encoding, compressing and writing a file
+        update      updating an existing file
+
+    The read and decompress phases include the data read from files opened
+    lazily, which is recorded whenever it is read. Phases may be nested, in
+    which case the time of the inner phase is not counted in the outer one,
+    so that the times of all phases add up to the total time spent.
+    """
+
+    def __init__(self):
+
+        self.phases = {}
+
+        # The phases which have been entered but not exited
+        self.active = []
+
+
+    def phase(self, name, size = 0):
+        """Return a context manager which records the time spent in the
+        named phase until it exits. The number of bytes processed can be
+        given or added to its size attribute before it exits."""
+
+        return ProfilePhase(self, name, size)
+
+
+    def add(self, name, elapsed, size):
+        """Record a call to the named phase which took the time given in
+        seconds and processed size bytes. The time is excluded from any
+        phases which are active."""
+
+        for phase in self.active:
+            phase.nested = phase.nested + elapsed
+
+        totals = self.phases.setdefault(name, {'time': 0.0, 'calls': 0, 'bytes': 0})
+        totals['time'] = totals['time'] + elapsed
+        totals['calls'] = totals['calls'] + 1
+        totals['bytes'] = totals['bytes'] + size
+
+
+    def as_dict(self):
+        """Return a dictionary containing the totals for each phase which
+        can be serialised as JSON."""
+
+        return {'version': 1, 'phases': self.phases}
+
+
+    def dump(self, f):
+        """Write the totals for each phase to the file object given as a
+        line of JSON."""
+
+        f.write(json.dumps(self.as_dict()) + '\n')
+
+
+class ProfilePhase(object):
+
+    def __init__(self, profile, name, size):
+
+        self.profile = profile
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+
+        self.nested = 0.0
+        self.profile.active.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        elapsed = time.time() - self.start
+        self.profile.active.remove(self)
+        self.profile.add(self.name, elapsed - self.nested, self.size)
+
+class NoProfilePhase(object):
+    """A phase used for instances without a profile, which records nothing.
+    Its size is always zero and values assigned to it are discarded, so a
+    single instance can be shared."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        pass
+
+    def get_size(self):
+
+        return 0
+
+    def set_size(self, size):
+
+        pass
+
+    size = property(get_size, set_size)
+
+# Used for instances without a profile
+no_profile = NoProfilePhase()
+
+
+class ProfiledFile(io.RawIOBase):
+    """file = ProfiledFile(file, profile, name)
+
+    Wrap the file object given, recording the time spent reading from it and
+    seeking in it as the named phase in the profile. The number of bytes
+    read or skipped over is recorded with the time.
+    """
+
+    def __init__(self, file, profile, name):
+
+        io.RawIOBase.__init__(self)
+        self.file = file
+        self.profile = profile
+        self.name = name
+
+
+    def readable(self):
+
+        return True
+
+
+    def seekable(self):
+
+        return True
+
+
+    def read(self, size = -1):
+
+        start = time.time()
+        data = self.file.read(size)
+        self.profile.add(self.name, time.time() - start, len(data))
+        return data
+
+
+    def readinto(self, b):
+
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+    def seek(self, offset, whence = 0):
+
+        start = time.time()
+        position = self.file.tell()
+        self.file.seek(offset, whence)
+        new_position = self.file.tell()
+        self.profile.add(self.name, time.time() - start,
+                         max(0, new_position - position))
+        return new_position
+
+
+    def tell(self):
+
+        return self.file.tell()
+
+
+    def close(self):
+
+        if not self.closed:
+            self.file.close()
+        io.RawIOBase.close(self)
+
+
+class BlockCodec:
+    """codec = BlockCodec()
+
+    Encode and decode the data blocks stored in tape chunks. Each block
+    starts with an alignment character and a file name of up to ten
+    characters, terminated by a zero byte. The name is followed by the
+    header fields described by header_struct, the header CRC, the block
+    data and the data CRC. The CRCs are stored with their high bytes first.
+
+    The fields of each header are packed and unpacked with precompiled
+    Struct objects. A list of blocks can be encoded in a single call, and
+    a sequence of headers can be decoded as each one is needed.
+    """
+
+    header = header_struct
+    crc = struct.Struct('>H')
+
+    # The longest header, with a ten character name, including the alignment
+    # character and the header CRC
+    header_limit = 12 + header_struct.size + 2
+
+    def decode_header(self, block):
+        """name, load, exec_addr, block_number, length, flag, header_crc,
+        data_start = decode_header(block)
+
+        Decode the header of a block held in a string or buffer, returning
+        its fields, the stored header CRC and the offset of the block data.
+        Only the header needs to be given, and the header_limit attribute
+        gives the number of bytes it can occupy for names of up to ten
+        characters. Raises IndexError if the block is too short to contain
+        a header."""
+
+        # Look for the end of the name in the first few bytes, only
+        # searching the whole block if the name is unusually long
+        a = block[1:12].find('\000')
+        if a == -1:
+            a = str(block).find('\000', 1) - 1
+            if a == -2:
+                raise IndexError, 'No file name in block.'
+
+        name = block[1:a + 1]
+        a = a + 2
+
+        if len(block) < a + self.header.size + self.crc.size:
+            raise IndexError, 'Block header is incomplete.'
+
+        load, exec_addr, block_number, length, flag, next_addr, unused = \
+            self.header.unpack_from(block, a)
+        header_crc = self.crc.unpack_from(block, a + self.header.size)[0]
+
+        return (name, load, exec_addr, block_number, length, flag,
+                header_crc, a + self.header.size + self.crc.size)
+
+
+    def decode(self, block):
+        """name, load, exec_addr, block_number, length, flag, header_crc,
+        data_crc, data_start = decode(block)
+
+        Decode a whole block held in a string or buffer, returning the
+        fields of its header, the stored CRCs and the offset of the block
+        data. The data CRC is None if the block is too short to hold one.
+        Raises IndexError if the block is too short to contain a header."""
+
+        header = self.decode_header(block)
+        data_start = header[-1]
+
+        if len(block) >= data_start + self.crc.size:
+            data_crc = self.crc.unpack_from(block, len(block) - 2)[0]
+        else:
+            data_crc = None
+
+        return header[:-1] + (data_crc, data_start)
+
+
+    def decode_headers(self, headers):
+        """Decode a sequence of block headers, returning an iterator over
+        tuples as returned by the decode_header method. The headers are
+        decoded as they are needed, so they can be read one at a time."""
+
+        decode_header = self.decode_header
+        for header in headers:
+            yield decode_header(header)
+
+
+    def encode(self, name, load, exe, block_number, data):
+        """Encode a single block containing the data given, returning it as
+        a string."""
+
+        return str(self.encode_blocks(name, load, exe, data[:256],
+                                      block_number)[0])
+
+
+    def encode_blocks(self, name, load, exe, data, first = 0):
+        """Encode file data as a list of data blocks, numbered from the
+        first block number given. There is always a block shorter than 256
+        bytes at the end of the data. The blocks are written to a single
+        bytearray and returned as buffers referring to it."""
+
+        prefix = '*' + name[:10] + '\000'
+        header_end = len(prefix) + self.header.size
+        overhead = header_end + self.crc.size*2
+
+        blocks = len(data)/256 + 1
+        out = bytearray(blocks * overhead + len(data))
+
+        pack_header = self.header.pack_into
+        pack_crc = self.crc.pack_into
+        crc_hqx = binascii.crc_hqx
+
+        load = load & 0xffffffff
+        exe = exe & 0xffffffff
+
+        encoded = []
+        offset = 0
+
+        for i in range(blocks):
+
+            length = min(256, len(data) - i*256)
+            if length == 256:
+                flag = 0
+            else:
+                flag = 128
+
+            # Header, including the alignment character, and header CRC
+            out[offset:offset + len(prefix)] = prefix
+            pack_header(out, offset + len(prefix), load, exe,
+                        (first + i) & 0xffff, length, flag, 0, 0)
+            pack_crc(out, offset + header_end,
+                     crc_hqx(buffer(out, offset + 1, header_end - 1), 0))
+
+            # Data and data CRC
+            start = offset + header_end + self.crc.size
+            block = buffer(data, i*256, length)
+            out[start:start + length] = block
+            pack_crc(out, start + length, crc_hqx(block, 0))
+
+            encoded.append(buffer(out, offset, overhead + length))
+            offset = offset + overhead + length
+
+        return encoded
+
+
+block_codec = BlockCodec()
+
 
-# Determine the platform on which the program is running
+class FileRecord(object):
+    """record = FileRecord(uef, name, load, exec_addr, blocks, position,
+                           last_position)
 
-sep = os.sep
+    Create an entry for the contents list of a UEFfile instance, uef,
+    describing a file with the name, load and execution addresses, and
+    number of blocks given, stored in the chunks from position to
+    last_position. The file's data is not stored in the record but read
+    from the chunks when it is needed.
+
+    The details of the file can be accessed as attributes or as the items
+    of a dictionary with the keys 'name', 'load', 'exec', 'blocks', 'data',
+    'position' and 'last position'.
+    """
+
+    __slots__ = ('uef', 'name', 'load', 'exec_addr', 'blocks', 'position',
+                 'last_position')
+
+    # Dictionary keys and the corresponding attributes
+    fields = {'name': 'name', 'load': 'load', 'exec': 'exec_addr',
+              'blocks': 'blocks', 'position': 'position',
+              'last position': 'last_position'}
+
+    def __init__(self, uef, name, load, exec_addr, blocks, position,
+                 last_position):
+
+        self.uef = uef
+        self.name = name
+        self.load = load
+        self.exec_addr = exec_addr
+        self.blocks = blocks
+        self.position = position
+        self.last_position = last_position
+
+
+    def data(self):
+        """Return the file's data, read from the blocks in the chunks."""
+
+        return self.uef.read_file_data(self)
+
+
+    def __getitem__(self, key):
+
+        if key == 'data':
+            return self.data()
+
+        try:
+            return getattr(self, self.fields[key])
+        except KeyError:
+            raise KeyError, key
+
+
+    def __setitem__(self, key, value):
+
+        try:
+            setattr(self, self.fields[key], value)
+        except KeyError:
+            raise KeyError, key
+
+
+    def __contains__(self, key):
+
+        return key == 'data' or self.fields.has_key(key)
+
+    has_key = __contains__
+
+
+    def get(self, key, default = None):
+
+        if key in self:
+            return self[key]
+
+        return default
+
+
+    def keys(self):
+
+        return ['name', 'load', 'exec', 'blocks', 'data', 'position', 'last position']
+
+
+    def items(self):
+
+        return map(lambda key: (key, self[key]), self.keys())
+
+
+    def __repr__(self):
+
+        return '<FileRecord %r load=%x exec=%x blocks=%i chunks %i to %i>' % (
+            self.name, self.load, self.exec_addr, self.blocks, self.position,
+            self.last_position)
+
+
+class UEFWriter:
+    """writer = UEFWriter(filename, minor, major, compresslevel, buffer_size,
+                         threads, block_size, points)
+
+    Create a UEF file with the specified filename and format version, to
+    which chunks can be written. The file is compressed with gzip at the
+    compression level given, from 0 (none) to 9 (best), or written without
+    compression if compresslevel is None. Chunks are collected in a buffer
+    and written to the file when at least buffer_size bytes have been
+    collected.
+
+    If threads is not None then the file is compressed in blocks of
+    block_size bytes by a ParallelGzipFile using a pool with that number of
+    threads. If a list of restart points is also given then the data of an
+    existing compressed file is replaced from the last of these points, as
+    described for ParallelGzipFile, and the UEF file header is not written.
+    """
+
+    def __init__(self, filename, minor = 9, major = 0, compresslevel = 9,
+                 buffer_size = 65536, threads = None, block_size = 1048576,
+                 points = None):
+
+        try:
+            if compresslevel == None:
+                self.file = open(filename, 'wb')
+            elif threads != None:
+                self.file = ParallelGzipFile(filename, compresslevel, threads,
+                                             block_size, points)
+            else:
+                self.file = gzip.GzipFile(filename, 'wb', compresslevel)
+        except IOError:
+            raise UEFfile_error, "Couldn't open %s for writing." % filename
+
+        self.buffer_size = buffer_size
+        self.pieces = []
+        self.buffered = 0
+
+        # The IDs and lengths of the chunks written
+        self.ids = array.array('H')
+        self.lengths = array.array('L')
+
+        # Write the UEF file header and version numbers
+        if not points:
+            self.write('UEF File!\000' + chr(minor) + chr(major))
+
+
+    def write(self, data):
+        """Write a string or buffer to the file via the buffer."""
+
+        if len(data) >= self.buffer_size:
+
+            # Write large pieces of data directly to the file
+            self.flush()
+            self.file.write(data)
+        else:
+            self.pieces.append(str(data))
+            self.buffered = self.buffered + len(data)
+
+            if self.buffered >= self.buffer_size:
+                self.flush()
+
+
+    def write_chunk(self, chunk_id, data):
+        """Write a chunk with the ID and data given."""
+
+        self.write(struct.pack('<HI', chunk_id, len(data)))
+        self.write(data)
+
+        self.ids.append(chunk_id)
+        self.lengths.append(len(data))
+
+
+    def write_chunks(self, chunks):
+        """Write the chunks supplied by a sequence or iterator of
+        (chunk ID, data) tuples."""
+
+        for chunk_id, data in chunks:
+            self.write_chunk(chunk_id, data)
+
+
+    def flush(self):
+        """Write the contents of the buffer to the file."""
+
+        if self.pieces:
+            self.file.write(''.join(self.pieces))
+            self.pieces = []
+            self.buffered = 0
+
+
+    def close(self):
+        """Write any buffered data and close the file."""
+
+        self.flush()
+        self.file.close()
 
-if sys.platform == 'RISCOS':
-    suffix = '/'
-else:
-    suffix = '.'
 
-version = '0.20'
-date = '2010-10-24'
-    
-    
 class UEFfile:
-    """instance = UEFfile(filename, creator)
+    """instance = UEFfile(filename, creator, lazy, mapped)
 
     Create an instance of a UEF container using an existing file.
     If filename is not defined then create a new UEF container.
     The creator parameter can be used to override the default
     creator string.
 
+    The chunks attribute is a ChunkList of (chunk ID, data) tuples, in which
+    each chunk's data is a string, and the contents attribute is a list of
+    FileRecord objects describing the files in the chunks.
+
+    If lazy is True then only the chunk headers are read from the file
+    and the chunks attribute is a ChunkTable which reads each chunk's data
+    from the file when it is accessed. A ChunkTable can have chunks deleted
+    from it but is otherwise read-only; methods which modify chunks replace
+    it with a ChunkList. The file remains open until the close method is
+    called.
+
+    If lazy is True and an index written by the write method is found
+    alongside the file then the chunk headers and contents list are read
+    from the index instead of the file. Compressed files written with an
+    index are read using an IndexedGzipFile, so that the data of each file
+    can be read without decompressing the data before it.
+
+    If mapped is True and the file is not compressed then the file is
+    memory-mapped and read lazily, with the data of each chunk supplied
+    as a buffer object referring to the mapped file. Compressed files are
+    read as if lazy were True.
+
+    If a Profile is given then the time spent in each phase of reading,
+    checking and writing files is recorded in it.
+
+    The instance keeps an index of chunk positions by chunk ID, which is
+    rebuilt when the chunks attribute is replaced or modified. Changes made
+    in place are only detected for the ChunkList and ChunkTable objects
+    created by the instance, so a plain list assigned to the chunks
+    attribute must not be modified in place without being assigned again.
     """
 
-    def __init__(self, filename = None, creator = 'UEFfile '+version):
+    def __init__(self, filename = None, creator = 'UEFfile '+version,
+                 lazy = False, mapped = False, profile = None):
         """Create a new instance of the UEFfile class."""
 
+        # The profile used to record the time spent in each phase of work
+        self.profile = profile
+
+        # The index of the file, if read lazily with an index
+        index = None
+
+        # The file or mapped file that chunk data is read from when reading
+        # lazily, and its filename
+        self.source = None
+        self.source_filename = None
+
+        # Whether chunk data is supplied as buffers referring to a mapped file
+        self.mapped = False
+
+        # The index of chunk positions by chunk ID is created when needed
+        self.id_index = {}
+        self.indexed_chunks = None
+        self.indexed_length = 0
+        self.indexed_changes = 0
+
         if filename == None:
 
             # There are no chunks initially
-            self.chunks = []
+            self.chunks = ChunkList()
             # There are no file positions defined
             self.files = []
 
@@ -78,101 +1155,578 @@ class UEFfile:
         else:
             # Read in the chunks from the file
 
-            # Open the input file
-            try:
-                in_f = open(filename, 'rb')
-            except IOError:
-                raise UEFfile_error, 'The input file, '+filename+' could not be found.'
+            # Open the input file
+            try:
+                in_f = open(filename, 'rb')
+            except IOError:
+                raise UEFfile_error, 'The input file, '+filename+' could not be found.'
+
+            # Is it gzipped?
+            compressed = in_f.read(10) != 'UEF File!\000'
+            if compressed:
+            
+                # Compressed files cannot be mapped, so read them lazily
+                lazy = lazy or mapped
+                mapped = False
+
+                in_f.close()
+                in_f = gzip.open(filename, 'rb')
+            
+                try:
+                    if in_f.read(10) != 'UEF File!\000':
+                        in_f.close()
+                        raise UEFfile_error, 'The input file, '+filename+' is not a UEF file.'
+                except:
+                    in_f.close()
+                    raise UEFfile_error, 'The input file, '+filename+' could not be read.'
+            
+            # Read version self.number of the file format
+            self.minor = self.str2num(1, in_f.read(1))
+            self.major = self.str2num(1, in_f.read(1))
+
+            # Decode the UEF file, recording the time spent reading the chunk
+            # headers and the UEF file information as the parse phase, with
+            # the number of bytes in the chunks
+            if compressed:
+                read_phase = 'decompress'
+            else:
+                read_phase = 'read'
+
+            with self.phase('parse') as parse:
+
+                if mapped:
+
+                    # Map the file into memory and index the chunks in the
+                    # mapped file, which remains valid after the file is closed
+                    try:
+                        in_map = mmap.mmap(in_f.fileno(), 0, access = mmap.ACCESS_READ)
+                    finally:
+                        in_f.close()
+
+                    self.chunks = ChunkTable(in_map, mapped = True)
+                    self.chunks.read_headers(12)
+                    parse.size = self.chunks.size()
+
+                    self.source = in_map
+                    self.source_filename = filename
+                    self.mapped = True
+
+                elif lazy:
+
+                    index = read_index(filename)
+
+                    if index != None:
+
+                        # Read the chunk headers from the index, opening the
+                        # file so that it can be read from the restart points
+                        # in the index
+                        in_f.close()
+
+                        if index['points']:
+                            in_f = IndexedGzipFile(filename, map(tuple, index['points']))
+                        else:
+                            in_f = open(filename, 'rb')
+
+                        self.chunks = ChunkTable(self.profiled_file(in_f, read_phase))
+                        self.chunks.add_headers(index['ids'], index['lengths'], 12)
+                    else:
+                        # Index the chunks, leaving the file open so that their
+                        # data can be read when needed
+                        self.chunks = ChunkTable(self.profiled_file(in_f, read_phase))
+                        self.chunks.read_headers()
+
+                    parse.size = self.chunks.size()
+                    self.source = self.chunks.source
+                    self.source_filename = filename
+
+                else:
+
+                    # Read the chunks into memory
+                    self.chunks, parse.size = self.read_chunks(
+                        self.profiled_file(in_f, read_phase))
+
+                    # Close the input file
+                    in_f.close()
+
+                # UEF file information (placed in "creator", "target_machine",
+                # "keyboard_layout", "emulator" and "features" attributes).
+                self.read_uef_details()
+
+            # Read file contents (placed in the list attribute "contents"),
+            # using the contents list in the index if it refers to the
+            # chunks that remain after the UEF file information was read.
+            if index != None and len(self.chunks) == len(index['ids']) - index['skip']:
+
+                with self.phase('contents'):
+
+                    self.contents = []
+                    for name, load, exec_addr, blocks, position, last in index['contents']:
+
+                        self.contents.append(FileRecord(self, name.encode('latin-1'),
+                            load, exec_addr, blocks, position, last))
+            else:
+                self.read_contents()
+
+
+    def read_chunks(self, in_f):
+        """Read the chunks from the current position in the file object given
+        to the end of the file. Return a ChunkList containing a (chunk ID,
+        data) tuple for each chunk and the number of bytes read."""
+
+        if not isinstance(in_f, file):
+            # Read compressed and profiled files through a large buffer to
+            # avoid the cost of many small reads from the file object
+            buffered = io.BufferedReader(in_f, 1048576)
+        else:
+            buffered = in_f
+
+        read = buffered.read
+        unpack = chunk_header_struct.unpack
+        chunks = []
+        size = 0
+
+        while 1:
+
+            # Read the chunk ID and length
+            header = read(6)
+            if len(header) < 6:
+                break
+
+            chunk_id, length = unpack(header)
+            data = read(length)
+            chunks.append((chunk_id, data))
+            size = size + 6 + len(data)
+
+        if buffered is not in_f:
+            # Release the file without closing it
+            buffered.detach()
+
+        return ChunkList(chunks), size
+
+
+    def profiled_file(self, in_f, name):
+        """Return the file object given, wrapped so that the time spent
+        reading it is recorded as the named phase if the instance has a
+        profile. The wrapped file is buffered so that small reads and seeks
+        are not recorded individually."""
+
+        if self.profile == None:
+            return in_f
+
+        return io.BufferedReader(ProfiledFile(in_f, self.profile, name))
+
+
+    def phase(self, name, size = 0):
+        """Return a context manager which records the time spent in the named
+        phase of work in the profile of the instance, if it has one."""
+
+        if self.profile == None:
+            return no_profile
+
+        return self.profile.phase(name, size)
+
+
+    def close(self):
+        """Close the file used to supply chunk data in lazy mode. Chunks
+        read from the file must not be used after it is closed."""
+
+        # The chunks may have been replaced by a list of chunks since the
+        # file was opened, so close the file itself
+        if self.source != None:
+            self.source.close()
+            self.source = None
+
+
+    def reads_from(self, filename):
+        """Return whether the chunk data of the instance is read from the
+        file with the specified filename when it is needed."""
+
+        if self.source == None or not os.path.exists(filename):
+            return False
+
+        if hasattr(os.path, 'samefile'):
+            return os.path.samefile(filename, self.source_filename)
+
+        return os.path.normcase(os.path.abspath(filename)) == \
+               os.path.normcase(os.path.abspath(self.source_filename))
+
+
+    def write(self, filename, write_creator_info = True,
+              write_machine_info = True, write_emulator_info = True,
+              compresslevel = 9, threads = None, index = False,
+              block_size = 1048576):
+        """
+        Write a UEF file containing all the information stored in an
+        instance of UEFfile to the file with the specified filename.
+
+        By default, information about the file's creator, target machine and
+        emulator is written to the file. These can be omitted by calling this
+        method with individual arguments set to False.
+
+        The file is compressed with gzip at the compression level given, or
+        written without compression if compresslevel is None. If threads is
+        not None then blocks of block_size bytes are compressed in parallel
+        by a pool with that number of threads.
+
+        If index is True then an index is written alongside the file for use
+        when it is read lazily. A compressed file with an index is always
+        compressed in blocks, as if threads were given, so that the index
+        can record the restart points at the start of each block.
+
+        If the instance reads chunk data lazily from the file being written
+        then the new file is written under a temporary name and replaces
+        the old file when it is complete.
+        """
+
+        if index and compresslevel != None and threads == None:
+            threads = 1
+
+        # If the chunk data is read from the file being written then write a
+        # new file and replace the old one with it afterwards
+        if self.reads_from(filename):
+            out_filename = filename + suffix + 'tmp'
+        else:
+            out_filename = filename
+
+        with self.phase('write') as phase:
+
+            # Open the UEF file for writing and write the UEF file header
+            writer = UEFWriter(out_filename, self.minor, self.major, compresslevel,
+                               threads = threads, block_size = block_size)
+
+            try:
+                try:
+                    # Write the chunks to the file
+                    writer.write_chunks(self.iter_chunks(write_creator_info,
+                                        write_machine_info, write_emulator_info))
+                finally:
+                    # Close the file
+                    writer.close()
+            except:
+                if out_filename != filename:
+                    os.remove(out_filename)
+                raise
+
+            phase.size = 12 + 6 * len(writer.lengths) + sum(writer.lengths)
+
+        if out_filename != filename:
+            replace_file(out_filename, filename)
+
+        if index:
+            if isinstance(writer.file, ParallelGzipFile):
+                points = writer.file.points
+            else:
+                points = []
+
+            self.write_index(filename, writer.ids, writer.lengths, points)
+        else:
+            self.remove_index(filename)
+
+
+    def update(self, filename, write_creator_info = True,
+               write_machine_info = True, write_emulator_info = True,
+               compresslevel = 9, threads = None, index = False,
+               block_size = 1048576):
+        """
+        Update the UEF file with the specified filename so that it contains
+        the same data as a file written by the write method with the same
+        arguments, rewriting only the parts of the file that have changed.
+
+        If the file is not compressed then chunks whose data has changed are
+        overwritten in place, and the file is only rewritten from the first
+        chunk whose ID or length has changed. If the file is compressed then
+        it is rewritten from the last restart point before the first change,
+        using the restart points recorded in its index. The whole file is
+        written if it does not exist, is not in the requested format, is
+        a compressed file without an index, or is the file that the chunk
+        data of the instance is read from.
+
+        An index is written alongside the file if index is True or if the
+        file already has one.
+        """
+
+        # Find the chunks that would be written
+        chunks = list(self.iter_chunks(write_creator_info,
+                      write_machine_info, write_emulator_info))
+
+        header = 'UEF File!\000' + chr(self.minor) + chr(self.major)
+
+        try:
+            f = open(filename, 'rb')
+            magic = f.read(10)
+            f.close()
+        except IOError:
+            magic = ''
+
+        old_index = read_index(filename)
+        index = index or old_index != None
+
+        # The file cannot be changed in place if the chunk data is read
+        # from it, so write a new file instead
+        if self.reads_from(filename):
+            self.write(filename, write_creator_info, write_machine_info,
+                       write_emulator_info, compresslevel, threads, index,
+                       block_size)
+            return
+
+        if compresslevel == None and magic == 'UEF File!\000':
+
+            with self.phase('update'):
+                self.update_raw(filename, header, chunks)
+            points = []
+
+        elif compresslevel != None and magic[:2] == '\037\213' and \
+             old_index != None and old_index['points']:
+
+            if threads == None:
+                threads = 1
+
+            with self.phase('update'):
+                points = self.update_compressed(filename, header, chunks,
+                            old_index, compresslevel, threads, block_size)
+
+            # The file and its index are unchanged
+            if points == None:
+                return
+        else:
+            self.write(filename, write_creator_info, write_machine_info,
+                       write_emulator_info, compresslevel, threads, index,
+                       block_size)
+            return
+
+        if index:
+            ids, lengths = self.chunk_lengths(chunks)
+            self.write_index(filename, ids, lengths, points)
+        else:
+            self.remove_index(filename)
+
+
+    def update_raw(self, filename, header, chunks):
+        """Update the uncompressed UEF file with the specified filename in
+        place so that it contains the UEF file header and list of chunks
+        given."""
+
+        f = open(filename, 'r+b')
+
+        try:
+            old_map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            old = ChunkTable(old_map, mapped = True)
+            old.read_headers(12)
+
+            # Find the chunks that can be overwritten in place and the
+            # first one from which the rest of the file must be rewritten
+            changed = []
+            end = len(chunks)
+
+            for i in range(len(chunks)):
+
+                chunk_id, data = chunks[i]
+
+                if i >= len(old) or old.ids[i] != chunk_id or \
+                   old.lengths[i] != len(data):
+                    end = i
+                    break
+
+                if str(old.read_data(i)) != str(data):
+                    changed.append(i)
+
+            header_changed = old_map[:12] != header
+
+            if end < len(old):
+                offset = old.offsets[end] - 6
+            else:
+                offset = len(old_map)
+
+            truncate = end < len(chunks) or len(old) > len(chunks) or \
+                       offset < len(old_map)
+
+            old_map.close()
+
+            if header_changed:
+                f.seek(0)
+                f.write(header)
+
+            for i in changed:
+                f.seek(old.offsets[i])
+                f.write(chunks[i][1])
+
+            if truncate:
+
+                # Write the remaining chunks after the last unchanged one
+                f.seek(offset)
+
+                pieces = []
+                for chunk_id, data in chunks[end:]:
+                    pieces.append(struct.pack('<HI', chunk_id, len(data)))
+                    pieces.append(str(data))
+
+                f.write(''.join(pieces))
+                f.truncate()
+        finally:
+            f.close()
+
+
+    def update_compressed(self, filename, header, chunks, old_index,
+                          compresslevel, threads, block_size):
+        """Update the compressed UEF file with the specified filename and
+        index so that it contains the UEF file header and list of chunks
+        given, rewriting it from the last restart point before the first
+        change. Returns the new list of restart points for the file, or
+        None if the file was unchanged."""
+
+        old_points = map(tuple, old_index['points'])
+        old_file = IndexedGzipFile(filename, old_points)
+
+        try:
+            old = ChunkTable(old_file)
+            old.add_headers(old_index['ids'], old_index['lengths'], 12)
+
+            # Find the offset in the uncompressed data of the first change
+            old_file.seek(0)
+            if old_file.read(12) != header:
+                change = 0
+            else:
+                change = None
+                offset = 12
+
+                for i in range(len(chunks)):
+
+                    chunk_id, data = chunks[i]
+
+                    if i >= len(old) or old.ids[i] != chunk_id or \
+                       old.lengths[i] != len(data) or \
+                       old.read_data(i) != str(data):
+                        change = offset
+                        break
+
+                    offset = offset + 6 + len(data)
+
+                if change == None and len(old) > len(chunks):
+                    change = offset
+        finally:
+            old_file.close()
+
+        if change == None:
+            return None
+
+        # Rewrite the file from the last restart point before the change
+        starts = map(lambda point: point[1], old_points)
+        j = bisect.bisect_right(starts, change) - 1
+        compressed, uncompressed, crc, chunk, offset = old_points[j]
+
+        # The data from the restart point to the next chunk header is the
+        # end of the UEF file header or of the chunk before it
+        if chunk == 0:
+            start = header[uncompressed:]
+        else:
+            chunk_id, data = chunks[chunk - 1]
+            piece = struct.pack('<HI', chunk_id, len(data)) + str(data)
+            start = piece[len(piece) - offset + uncompressed:]
+
+        writer = UEFWriter(filename, self.minor, self.major, compresslevel,
+                           threads = threads, block_size = block_size,
+                           points = old_points[:j + 1])
+        try:
+            writer.write(start)
+            writer.write_chunks(chunks[chunk:])
+        finally:
+            writer.close()
+
+        return writer.file.points
+
+
+    def chunk_lengths(self, chunks):
+        """Return arrays containing the IDs and lengths of the chunks in the
+        list given."""
+
+        ids = array.array('H')
+        lengths = array.array('L')
 
-            # Is it gzipped?
-            if in_f.read(10) != 'UEF File!\000':
-            
-                in_f.close()
-                in_f = gzip.open(filename, 'rb')
-            
-                try:
-                    if in_f.read(10) != 'UEF File!\000':
-                        in_f.close()
-                        raise UEFfile_error, 'The input file, '+filename+' is not a UEF file.'
-                except:
-                    in_f.close()
-                    raise UEFfile_error, 'The input file, '+filename+' could not be read.'
-            
-            # Read version self.number of the file format
-            self.minor = self.str2num(1, in_f.read(1))
-            self.major = self.str2num(1, in_f.read(1))
+        for chunk_id, data in chunks:
+            ids.append(chunk_id)
+            lengths.append(len(data))
 
-            # Decode the UEF file
-            
-            # List of chunks
-            self.chunks = []
-            
-            # Read chunks
-            
-            while 1:
-            
-                # Read chunk ID
-                chunk_id = in_f.read(2)
-                if not chunk_id:
-                    break
-            
-                chunk_id = self.str2num(2, chunk_id)
-            
-                length = self.str2num(4, in_f.read(4))
-            
-                if length != 0:
-                    self.chunks.append((chunk_id, in_f.read(length)))
-                else:
-                    self.chunks.append((chunk_id, ''))
+        return ids, lengths
 
-            # Close the input file
-            in_f.close()
 
-            # UEF file information (placed in "creator", "target_machine",
-            # "keyboard_layout", "emulator" and "features" attributes).
-            self.read_uef_details()
+    def write_index(self, filename, ids, lengths, points):
+        """Write an index for the UEF file with the specified filename,
+        containing chunks with the IDs and lengths given and compressed
+        with the restart points listed, to a file with the same name and an
+        "idx" suffix."""
 
-            # Read file contents (placed in the list attribute "contents").
-            self.read_contents()
+        # Find the offset of each chunk header in the uncompressed data
+        starts = []
+        offset = 12
+        for length in lengths:
+            starts.append(offset)
+            offset = offset + 6 + length
 
+        # Record the first chunk and its offset after each restart point
+        restart_points = []
+        for compressed, uncompressed, crc in points:
 
-    def write(self, filename, write_creator_info = True,
-              write_machine_info = True, write_emulator_info = True):
-        """
-        Write a UEF file containing all the information stored in an
-        instance of UEFfile to the file with the specified filename.
+            chunk = bisect.bisect_left(starts, uncompressed)
+            if chunk < len(starts):
+                offset = starts[chunk]
+            else:
+                offset = uncompressed
 
-        By default, information about the file's creator, target machine and
-        emulator is written to the file. These can be omitted by calling this
-        method with individual arguments set to False.
-        """
+            restart_points.append((compressed, uncompressed, crc, chunk, offset))
+
+        contents = []
+        for details in self.contents:
+            contents.append((details['name'].decode('latin-1'), details['load'],
+                             details['exec'], details['blocks'],
+                             details['position'], details['last position']))
+
+        # The size and modification time of the file are recorded so that
+        # the index is ignored if the file is later replaced
+        index = {'version': 2, 'size': os.path.getsize(filename),
+                 'mtime': os.path.getmtime(filename),
+                 'points': restart_points,
+                 'ids': list(ids), 'lengths': list(lengths),
+                 'skip': len(ids) - len(self.chunks),
+                 'contents': contents}
 
-        # Open the UEF file for writing
         try:
-            uef = gzip.open(filename, 'wb')
+            f = open(filename + suffix + 'idx', 'w')
+            json.dump(index, f)
+            f.close()
         except IOError:
-            raise UEFfile_error, "Couldn't open %s for writing." % filename
-    
-        # Write the UEF file header
-        self.write_uef_header(uef)
+            raise UEFfile_error, "Couldn't write the index for %s." % filename
+
+
+    def remove_index(self, filename):
+        """Remove any index written alongside the UEF file with the specified
+        filename, so that an index for an earlier version of the file is not
+        used with the new one."""
+
+        try:
+            os.remove(filename + suffix + 'idx')
+        except OSError:
+            pass
+
+
+    def iter_chunks(self, write_creator_info = True,
+                    write_machine_info = True, write_emulator_info = True):
+        """
+        Return an iterator over the chunks to be written to a UEF file,
+        starting with the creator, machine and emulator information chunks
+        unless these are omitted by setting individual arguments to False.
+        """
 
         if write_creator_info:
-            # Write the UEF creator chunk to the file
-            self.write_uef_creator(uef)
+            yield self.creator_chunk()
 
         if write_machine_info:
-            # Write the machine information
-            self.write_machine_info(uef)
+            yield self.machine_chunk()
 
         if write_emulator_info:
-            # Write the emulator information
-            self.write_emulator_info(uef)
-    
-        # Write the chunks to the file
-        self.write_chunks(uef)
-    
-        # Close the file
-        uef.close()
+            yield self.emulator_chunk()
+
+        for c in self.chunks:
+            yield c
 
 
     def number(self, size, n):
@@ -241,7 +1795,9 @@ class UEFfile:
         return n, carry
 
 
-    def crc(self, s):
+    def bitwise_crc(self, s):
+        """Calculate the CRC of a string one bit at a time. This is the
+        reference implementation of the algorithm used by crc."""
 
         high = 0
         low = 0
@@ -263,294 +1819,587 @@ class UEFfile:
 
         return high | (low << 8)
 
+
+    def crc(self, s):
+        """Calculate the CRC used in tape block headers and data.
+
+        This is the CCITT polynomial (0x1021) with a zero initial value,
+        so the table-driven implementation in the binascii module is used,
+        with the high byte of the result stored first."""
+
+        n = binascii.crc_hqx(s, 0)
+        return (n >> 8) | ((n & 0xff) << 8)
+
+
+    def block_crcs(self, name, load, exe, data):
+        """crcs = block_crcs(name, load, exe, data)
+
+        Return a list of (header CRC, data CRC) tuples for the blocks that
+        write_block would create when encoding the file data given."""
+
+        # The header follows the alignment character and contains the name,
+        # load and execution addresses, block number, block length, flag and
+        # two unused words
+        prefix = name[:10] + '\000' + struct.pack('<II', load & 0xffffffff,
+                                                  exe & 0xffffffff)
+        crc_hqx = binascii.crc_hqx
+        prefix_crc = crc_hqx(prefix, 0)
+
+        with self.phase('crc', len(data)):
+
+            crcs = []
+
+            # There is always a block shorter than 256 bytes at the end of a file
+            for block_number in range(len(data)/256 + 1):
+
+                block = data[block_number*256:(block_number+1)*256]
+
+                if len(block) == 256:
+                    flag = 0
+                else:
+                    flag = 128
+
+                header = struct.pack('<HHBHH', block_number & 0xffff, len(block),
+                                     flag, 0, 0)
+                header_crc = crc_hqx(header, prefix_crc)
+                data_crc = crc_hqx(block, 0)
+
+                crcs.append(((header_crc >> 8) | ((header_crc & 0xff) << 8),
+                             (data_crc >> 8) | ((data_crc & 0xff) << 8)))
+
+        return crcs
+
     # CRC calculation routines (end)
 
     def read_contents(self):
         """Find the positions of files in the list of chunks"""
-        
-        # List of files
-        self.contents = []
-        
-        current_file = {}
-        
-        position = 0
-        
-        while 1:
-        
-            position = self.find_next_block(position)
-        
-            if position == None:
-        
-                # No more blocks, so store the details of the last file in
-                # the contents list
-                if current_file != {}:
-                    self.contents.append(current_file)
-                break
-        
-            else:
-        
+
+        with self.phase('contents'):
+
+            # List of files
+            self.contents = []
+
+            current_file = None
+
+            # Find the positions of the blocks and decode their headers, reading
+            # only the start of each block
+            positions = []
+            position = self.find_next_block(0)
+
+            while position != None:
+                positions.append(position)
+                position = self.find_next_block(position + 1)
+
+            headers = block_codec.decode_headers(
+                itertools.imap(self.block_header_bytes, positions))
+
+            for position, header in itertools.izip(positions, headers):
+
                 # Read the block information
-                name, load, exec_addr, data, block_number, last = self.read_block(self.chunks[position])
-        
-                if current_file == {}:
-        
-                    # No current file, so store details
-                    current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number, 'data': data}
-        
-                    # Locate the first non-block chunk before the block
-                    # and store the position of the file
-                    current_file['position'] = self.find_file_start(position)
-                    # This may also be the position of the last chunk related to
-                    # this file in the archive
-                    current_file['last position'] = position
+                name, load, exec_addr, block_number, length, flag, header_crc, \
+                    data_start = header
+
+                if current_file == None or block_number == 0:
+
+                    # New file, so write any previous one to the
+                    # contents list
+                    if current_file != None:
+                        self.contents.append(current_file)
+
+                    # Store details of this new file, locating the first
+                    # non-block chunk before the block as the position of
+                    # the file. This block may also be the last chunk
+                    # related to this file in the archive.
+                    current_file = FileRecord(self, name, load, exec_addr, block_number,
+                                              self.find_file_start(position), position)
                 else:
-        
-                    # Current file exists
-                    if block_number == 0:
-        
-                        # New file, so write the previous one to the
-                        # contents list, but before doing so, find the next
-                        # non-block chunk and mark that as the last chunk in
-                        # the file
-        
-                        if current_file != {}:
-                            self.contents.append(current_file)
-        
-                        # Store details of this new file
-                        current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number, 'data': data}
-        
-                        # Locate the first non-block chunk before the block
-                        # and store the position of the file
-                        current_file['position'] = self.find_file_start(position)
-                        # This may also be the position of the last chunk related to
-                        # this file in the archive
-                        current_file['last position'] = position
-                    else:
-                        # Not a new file, so update the number of
-                        # blocks and append the block data to the
-                        # data entry
-                        current_file['blocks'] = block_number
-                        current_file['data'] = current_file['data'] + data
-        
-                        # Update the last position information to mark the end of the file
-                        current_file['last position'] = position
-        
-            # Increase the position
-            position = position + 1
+                    # Not a new file, so update the number of blocks and
+                    # the last position information to mark the end of
+                    # the file
+                    current_file.blocks = block_number
+                    current_file.last_position = position
+
+            # No more blocks, so store the details of the last file in the
+            # contents list
+            if current_file != None:
+                self.contents.append(current_file)
+
+            # We now have a contents list which tells us
+            # 1) the names of files in the archive
+            # 2) the load and execution addresses of them
+            # 3) the number of blocks they contain
+            # 4) their start and end positions (chunk numbers) in the
+            #    archive, from which their data can be read
+
+
+    def block_header_bytes(self, position):
+        """Return the bytes at the start of the data block in the chunk at
+        the position given which contain the block's header."""
+
+        chunk_id = self.chunk_id(position)
+        limit = block_codec.header_limit
+
+        if chunk_id == 0x102:
+            # Each byte is encoded as ten bits, following a byte which gives
+            # the number of bits to ignore at the end of the data
+            limit = (limit * 10 + 7)/8 + 3
+
+        if isinstance(self.chunks, ChunkTable):
+            data = self.chunks.read_data(position, limit)
+        else:
+            data = self.chunks[position][1][:limit]
+
+        header = self.block_bytes((chunk_id, data))
+
+        # Read the whole block if the name is unusually long
+        if str(header).find('\000', 1) == -1 and len(data) == limit:
+            header = self.block_bytes(self.chunks[position])
+
+        return header
+
+
+    def read_file_data(self, details):
+        """Return the data in the blocks of the file described by the record
+        in the contents list given."""
+
+        return self.join_data(list(self.iter_file_data(details)))
+
+
+    def iter_file_data(self, details):
+        """Return an iterator over the data in each block of the file
+        described by the record in the contents list given, reading each
+        block only when it is needed."""
+
+        position = self.find_next_block(details.position)
+        while position != None and position <= details.last_position:
+
+            yield self.read_block(self.chunks[position])[3]
+            position = self.find_next_block(position + 1)
+
+
+    def join_data(self, pieces):
+        """Join a list of strings or buffers containing file data, returning
+        a string. For instances reading a mapped file, a single piece of data
+        is returned as a buffer to avoid copying it."""
+
+        if len(pieces) == 1 and self.mapped:
+            return pieces[0]
+
+        return ''.join(map(str, pieces))
+
+
+    def verify(self, pool = None, batch_size = 256):
+        """bad_blocks = verify(pool, batch_size)
+
+        Check the header and data CRCs of every block of every file in the
+        contents list. Return a list of tuples describing the blocks with
+        incorrect CRCs:
+
+            (file number, name, block number, chunk position,
+             header CRC is correct, data CRC is correct)
+
+        If a multiprocessing pool is given then the blocks are checked in
+        batches of batch_size blocks by the processes in the pool.
+        """
+
+        # Find the positions of the blocks in each file
+        blocks = []
+
+        for file_number in range(len(self.contents)):
+
+            details = self.contents[file_number]
+            position = self.find_next_block(details['position'])
+
+            while position != None and position <= details['last position']:
+
+                blocks.append((file_number, position))
+                position = self.find_next_block(position + 1)
+
+        with self.phase('crc') as phase:
+
+            # Check batches of blocks, passing their contents as implicit
+            # tape data so that they can be sent to other processes
+            batches = []
+            for i in range(0, len(blocks), batch_size):
+
+                batch = []
+                for file_number, position in blocks[i:i+batch_size]:
+                    batch.append((0x100, str(self.block_bytes(self.chunks[position]))))
+                    phase.size = phase.size + len(batch[-1][1])
+
+                batches.append(batch)
+
+            if pool == None:
+                results = map(check_blocks, batches)
+            else:
+                results = pool.map(check_blocks, batches)
+
+        bad_blocks = []
+        i = 0
+        for batch_results in results:
+
+            for block_number, header_ok, data_ok in batch_results:
+
+                if not header_ok or not data_ok:
+
+                    file_number, position = blocks[i]
+                    bad_blocks.append((file_number, self.contents[file_number]['name'],
+                                       block_number, position, header_ok, data_ok))
+                i = i + 1
+
+        return bad_blocks
+
+
+    def chunk(self, f, n, data):
+        """Write a chunk to the file specified by the open file object, chunk number and data supplied."""
+
+        # Chunk ID
+        f.write(self.number(2, n))
+        # Chunk length
+        f.write(self.number(4, len(data)))
+        # Data
+        f.write(data)
+
+
+    def read_block(self, chunk):
+        """Read a data block from a tape chunk and return the program name, load and execution addresses,
+        block data, block number and whether the block is supposedly the last in the file."""
+
+        block = self.block_bytes(chunk)
+
+        name, load, exec_addr, block_number, length, flag, header_crc, \
+            a = block_codec.decode_header(block)
+
+        if flag & 0x80 != 0:
+            last = 1
+        else:
+            last = 0
+
+        if type(block) == types.BufferType:
+
+            # Refer to the data in the block instead of copying it
+            data = buffer(block, a, max(0, len(block) - a - 2))
+        else:
+            data = block[a:-2]
+
+        return (name, load, exec_addr, data, block_number, last)
+
+
+    def check_block(self, chunk):
+        """header_ok, data_ok = check_block(chunk)
+
+        Compare the header and data CRCs stored in a data block from a tape
+        chunk with those calculated from its contents."""
+
+        block = self.block_bytes(chunk)
+
+        try:
+            name, load, exec_addr, block_number, length, flag, header_crc, \
+                data_crc, a = block_codec.decode(block)
+        except IndexError:
+            return False, False
+
+        # The header CRC covers the name and header fields, and the data
+        # CRC follows the data
+        if data_crc is None:
+            return False, False
+
+        header_ok = header_crc == binascii.crc_hqx(block[1:a-2], 0)
+        data_ok = data_crc == binascii.crc_hqx(block[a:-2], 0)
+
+        return header_ok, data_ok
+
+
+    def block_bytes(self, chunk):
+        """Return the bytes of the data block in a tape chunk."""
+
+        # Chunk number and data
+        chunk_id = chunk[0]
+        data = chunk[1]
+
+        # For the implicit tape data chunk, just read the block as a series
+        # of bytes, as before
+        if chunk_id == 0x100:
+
+            block = data
+
+        else:   # 0x102
+
+            block = self.decode_defined_data(data)
+
+        return block
+
+
+    def decode_defined_data(self, data):
+        """Convert the data from a defined tape format chunk (0x102) to a
+        string of bytes. The data is a stream of bits, stored with the first
+        bit in the least significant bit of each byte, in which each byte is
+        preceded by a start bit and followed by a stop bit."""
+
+        if self.major == 0 and self.minor < 9:
+
+            # For UEF file versions earlier than 0.9, the number of
+            # excess bits to be ignored at the end of the stream is
+            # set to zero implicitly
+            ignore = 0
+            bit_ptr = 0
+        else:
+            # For later versions, the number of excess bits is
+            # specified in the first byte of the stream
+            ignore = ord(data[0])
+            bit_ptr = 8
+
+        # Only read complete ten bit frames
+        frames = max(0, (len(data)*8 - ignore - bit_ptr) / 10)
+
+        if numpy != None:
+
+            # Unpack the bits in each byte, least significant bit first
+            bits = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8))
+            bits = bits.reshape((len(data), 8))[:, ::-1].reshape(-1)
+
+            # Arrange the frames in rows and pack the data bits in each
+            # row into a byte, skipping the start and stop bits
+            frames = bits[bit_ptr:bit_ptr + frames*10].reshape((frames, 10))
+            return numpy.packbits(frames[:, 8:0:-1], axis = 1).tostring()
+
+        # Append a zero byte so that each frame can be read from two bytes
+        data = map(ord, data) + [0]
+        block = []
+
+        for i in range(frames):
+
+            # Skip the start bit
+            start = bit_ptr + 1
+
+            # Read eight bits from the byte containing the first bits and
+            # the byte containing the rest
+            n = data[start >> 3] | (data[(start >> 3) + 1] << 8)
+            block.append(chr((n >> (start & 7)) & 0xff))
+
+            # Move the data pointer on to the next frame
+            bit_ptr = bit_ptr + 10
+
+        return ''.join(block)
+
+
+    def write_block(self, block, name, load, exe, n):
+        """Write data to a string as a file data block in preparation to be written
+        as chunk data to a UEF file."""
+
+        out = block_codec.encode(name, load, exe, n, block)
+
+        if len(block) == 256:
+            last = 0
+        else:
+            last = 1
+
+        return out, last
+
+
+    def get_leafname(self, path):
+        """Get the leafname of the specified file."""
+
+        pos = string.rfind(path, os.sep)
+        if pos != -1:
+            return path[pos+1:]
+        else:
+            return path
+
+
+    def find_next_chunk(self, pos, IDs):
+        """position, chunk = find_next_chunk(start, IDs)
+        Search through the list of chunks from the start position given
+        for the next chunk with an ID in the list of IDs supplied.
+        Return its position in the list of chunks and its details."""
+
+        index = self.chunk_index()
+        found = None
+
+        for chunk_id in IDs:
 
-            # We now have a contents list which tells us
-            # 1) the names of files in the archive
-            # 2) the load and execution addresses of them
-            # 3) the number of blocks they contain
-            # 4) their data, and from this their length
-            # 5) their start position (chunk number) in the archive
+            # Find the first chunk with this ID at or after the start
+            positions = index.get(chunk_id, [])
+            i = bisect.bisect_left(positions, pos)
 
+            if i < len(positions) and (found == None or positions[i] < found):
+                found = positions[i]
 
-    def chunk(self, f, n, data):
-        """Write a chunk to the file specified by the open file object, chunk number and data supplied."""
+        if found == None:
+            return None, None
 
-        # Chunk ID
-        f.write(self.number(2, n))
-        # Chunk length
-        f.write(self.number(4, len(data)))
-        # Data
-        f.write(data)
+        return found, self.chunks[found]
 
 
-    def read_block(self, chunk):
-        """Read a data block from a tape chunk and return the program name, load and execution addresses,
-        block data, block number and whether the block is supposedly the last in the file."""
+    def find_next_block(self, pos):
+        """Find the next file block in the list of chunks."""
 
-        # Chunk number and data
-        chunk_id = chunk[0]
-        data = chunk[1]
+        index = self.chunk_index()
+        found = None
 
-        # For the implicit tape data chunk, just read the block as a series
-        # of bytes, as before
-        if chunk_id == 0x100:
+        for chunk_id in (0x100, 0x102):
 
-            block = data
+            positions = index.get(chunk_id, [])
+            i = bisect.bisect_left(positions, pos)
 
-        else:   # 0x102
+            # Skip chunks which are too short to contain blocks
+            while i < len(positions) and self.chunk_length(positions[i]) <= 1:
+                i = i + 1
 
-            if UEF_major == 0 and UEF_minor < 9:
+            if i < len(positions) and (found == None or positions[i] < found):
+                found = positions[i]
 
-                # For UEF file versions earlier than 0.9, the number of
-                # excess bits to be ignored at the end of the stream is
-                # set to zero implicitly
-                ignore = 0
-                bit_ptr = 0
-            else:
-                # For later versions, the number of excess bits is
-                # specified in the first byte of the stream
-                ignore = data[0]
-                bit_ptr = 8
+        return found
 
-            # Convert the data to the implicit format
-            block = []
-            write_ptr = 0
 
-            after_end = (len(data)*8) - ignore
-            if after_end % 10 != 0:
+    def chunk_ids(self):
+        """Return a sequence containing the ID of each chunk."""
 
-                # Ensure that the number of bits to be read is a
-                # multiple of ten
-                after_end = after_end - (after_end % 10)
+        if isinstance(self.chunks, ChunkTable):
+            return self.chunks.ids
 
-            while bit_ptr < after_end:
+        return map(lambda chunk: chunk[0], self.chunks)
 
-                # Skip start bit
-                bit_ptr = bit_ptr + 1
 
-                # Read eight bits of data
-                bit_offset = bit_ptr % 8
-                if bit_offset == 0:
-                    # Write the byte to the block
-                    block[write_ptr] = data[bit_ptr >> 3]
-                else:
-                    # Read the byte containing the first bits
-                    b1 = data[bit_ptr >> 3]
-                    # Read the byte containing the rest
-                    b2 = data[(bit_ptr >> 3) + 1]
-
-                    # Construct a byte of data
-                    # Shift the first byte right by the bit offset
-                    # in that byte
-                    b1 = b1 >> bit_offset
-
-                    # Shift the rest of the bits from the second
-                    # byte to the left and ensure that the result
-                    # fits in a byte
-                    b2 = (b2 << (8 - bit_offset)) & 0xff
-
-                    # OR the two bytes together and write it to
-                    # the block
-                    block[write_ptr] = b1 | b2
-
-                # Increment the block pointer
-                write_ptr = write_ptr + 1
-
-                # Move the data pointer on eight bits and skip the
-                # stop bit
-                bit_ptr = bit_ptr + 9
-
-        # Read the block
-        name = ''
-        a = 1
-        while 1:
-            c = block[a]
-            if ord(c) != 0:     # was > 32:
-                name = name + c
-            a = a + 1
-            if ord(c) == 0:
-                break
+    def chunk_id(self, pos):
+        """Return the ID of the chunk at the position given without reading
+        its data."""
 
-        load = self.str2num(4, block[a:a+4])
-        exec_addr = self.str2num(4, block[a+4:a+8])
-        block_number = self.str2num(2, block[a+8:a+10])
-        last = self.str2num(1, block[a+12])
+        if isinstance(self.chunks, ChunkTable):
+            return self.chunks.ids[pos]
 
-        if last & 0x80 != 0:
-            last = 1
-        else:
-            last = 0
+        return self.chunks[pos][0]
 
-        return (name, load, exec_addr, block[a+19:-2], block_number, last)
 
+    def chunk_length(self, pos):
+        """Return the length of the data in the chunk at the position given."""
 
-    def write_block(self, block, name, load, exe, n):
-        """Write data to a string as a file data block in preparation to be written
-        as chunk data to a UEF file."""
+        if isinstance(self.chunks, ChunkTable):
+            return self.chunks.lengths[pos]
 
-        # Write the alignment character
-        out = "*"+name[:10]+"\000"
+        return len(self.chunks[pos][1])
 
-        # Load address
-        out = out + self.number(4, load)
 
-        # Execution address
-        out = out + self.number(4, exe)
+    def chunk_index(self):
+        """Return a dictionary mapping each chunk ID to a sorted list of the
+        positions of the chunks with that ID. The index is recreated if the
+        list of chunks has been replaced, changed in length or, for lists
+        which count their changes, modified by other code since it was last
+        updated."""
 
-        # Block number
-        out = out + self.number(2, n)
+        if self.indexed_chunks is not self.chunks or \
+           self.indexed_length != len(self.chunks) or \
+           self.indexed_changes != getattr(self.chunks, 'changes', 0):
 
-        # Block length
-        out = out + self.number(2, len(block))
+            self.id_index = {}
 
-        # Block flag (last block)
-        if len(block) == 256:
-            out = out + self.number(1, 0)
-            last = 0
-        else:
-            out = out + self.number(1, 128) # shouldn't be needed 
-            last = 1 
+            pos = 0
+            for chunk_id in self.chunk_ids():
+                self.id_index.setdefault(chunk_id, []).append(pos)
+                pos = pos + 1
 
-        # Next address
-        out = out + self.number(2, 0)
+            self.index_updated()
 
-        # Unknown
-        out = out + self.number(2, 0)
+        return self.id_index
 
-        # Header CRC
-        out = out + self.number(2, self.crc(out[1:]))
 
-        out = out + block
+    def index_updated(self):
+        """Record that the chunk index is up to date with the current list of
+        chunks."""
 
-        # Block CRC
-        out = out + self.number(2, self.crc(block))
+        self.indexed_chunks = self.chunks
+        self.indexed_length = len(self.chunks)
+        self.indexed_changes = getattr(self.chunks, 'changes', 0)
 
-        return out, last
 
+    def index_inserted(self, insertions):
+        """Update the chunk index after chunks have been inserted into the
+        list of chunks. insertions is a list of (position, ids) tuples, sorted
+        by position, giving the IDs of the chunks inserted before each
+        position in the original list."""
 
-    def get_leafname(self, path):
-        """Get the leafname of the specified file."""
+        starts = map(lambda item: item[0], insertions)
 
-        pos = string.rfind(path, os.sep)
-        if pos != -1:
-            return path[pos+1:]
-        else:
-            return path
+        # Count the chunks inserted before the end of each insertion and
+        # find the new positions of the inserted chunks with each ID
+        inserted_before = [0]
+        inserted = {}
 
+        for position, ids in insertions:
 
-    def find_next_chunk(self, pos, IDs):
-        """position, chunk = find_next_chunk(start, IDs)
-        Search through the list of chunks from the start position given
-        for the next chunk with an ID in the list of IDs supplied.
-        Return its position in the list of chunks and its details."""
+            new_position = position + inserted_before[-1]
+            for chunk_id in ids:
+                inserted.setdefault(chunk_id, []).append(new_position)
+                new_position = new_position + 1
 
-        while pos < len(self.chunks):
+            inserted_before.append(inserted_before[-1] + len(ids))
 
-            if self.chunks[pos][0] in IDs:
+        for chunk_id, positions in self.id_index.items():
 
-                # Found a chunk with ID in the list
-                return pos, self.chunks[pos]
+            # Move each chunk by the number of chunks inserted at or before
+            # its original position
+            new_positions = []
+            for pos in positions:
+                new_positions.append(pos + inserted_before[bisect.bisect_right(starts, pos)])
 
-            # Otherwise continue looking
-            pos = pos + 1
+            # Both lists are sorted, so they are merged in linear time
+            new_positions.extend(inserted.pop(chunk_id, []))
+            new_positions.sort()
+            self.id_index[chunk_id] = new_positions
 
-        return None, None
+        for chunk_id, positions in inserted.items():
+            self.id_index[chunk_id] = positions
 
+        self.index_updated()
 
-    def find_next_block(self, pos):
-        """Find the next file block in the list of chunks."""
 
-        while pos < len(self.chunks):
+    def index_removed(self, ranges):
+        """Update the chunk index after the chunks in a sorted list of
+        non-overlapping (first, last) position ranges have been removed from
+        the list of chunks."""
 
-            pos, chunk = self.find_next_chunk(pos, [0x100, 0x102])
+        starts = map(lambda r: r[0], ranges)
 
-            if pos == None:
+        # Count the chunks removed before the end of each range
+        removed = [0]
+        for first, last in ranges:
+            removed.append(removed[-1] + last - first + 1)
 
-                return None
+        for chunk_id, positions in self.id_index.items():
+
+            new_positions = []
+
+            for pos in positions:
+
+                # Find the range starting at or before this position
+                r = bisect.bisect_right(starts, pos) - 1
+
+                if r >= 0 and pos <= ranges[r][1]:
+                    # The chunk was removed
+                    continue
+
+                new_positions.append(pos - removed[r + 1])
+
+            if new_positions:
+                self.id_index[chunk_id] = new_positions
             else:
-                if len(chunk[1]) > 1:
+                del self.id_index[chunk_id]
 
-                    # Found a block, return this position
-                    return pos
+        self.index_updated()
 
-            # Otherwise continue looking
-            pos = pos + 1
 
-        return None
+    def delete_chunk(self, pos):
+        """Delete the chunk at the position given, updating the chunk index."""
+
+        self.chunk_index()
+        del self.chunks[pos]
+        self.index_removed([(pos, pos)])
+
+
+    def is_block(self, chunk):
+        """Return whether the chunk specified contains a file block."""
+
+        return (chunk[0] == 0x100 or chunk[0] == 0x102) and len(chunk[1]) > 1
 
 
     def find_file_start(self, pos):
@@ -559,7 +2408,8 @@ class UEFfile:
         pos = pos - 1
         while pos > 0:
 
-            if self.chunks[pos][0] != 0x100 and self.chunks[pos][0] != 0x102:
+            chunk_id = self.chunk_id(pos)
+            if chunk_id != 0x100 and chunk_id != 0x102:
 
                 # This is not a block
                 return pos
@@ -576,7 +2426,8 @@ class UEFfile:
         pos = pos + 1
         while pos < len(self.chunks)-1:
 
-            if self.chunks[pos][0] != 0x100 and self.chunks[pos][0] != 0x102:
+            chunk_id = self.chunk_id(pos)
+            if chunk_id != 0x100 and chunk_id != 0x102:
 
                 # This is not a block
                 return pos
@@ -587,6 +2438,164 @@ class UEFfile:
         return pos
 
 
+    def timing_chunk(self, chunk_id, value):
+        """Return a chunk with the ID given containing a timing value: a
+        carrier tone (0x110) or integer gap (0x112) in cycles at twice the
+        base frequency, a base frequency in Hz (0x113), a gap in seconds
+        (0x116) or the baud rate used to encode data (0x117)."""
+
+        try:
+            return (chunk_id, timing_structs[chunk_id].pack(value))
+        except KeyError:
+            raise UEFfile_error, 'Chunk &%x is not a timing chunk.' % chunk_id
+
+
+    def read_timing_chunk(self, chunk):
+        """Return the timing value contained in a chunk created by the
+        timing_chunk method, or in a chunk read from a file."""
+
+        try:
+            format = timing_structs[chunk[0]]
+        except KeyError:
+            raise UEFfile_error, 'Chunk &%x is not a timing chunk.' % chunk[0]
+
+        if len(chunk[1]) < format.size:
+            raise UEFfile_error, 'Timing chunk &%x is too short.' % chunk[0]
+
+        return format.unpack_from(chunk[1])[0]
+
+
+    def tape_time(self, chunks = None, baud = 1200):
+        """Return the time in seconds taken to play the list of chunks given,
+        or the chunks of the instance if chunks is None, starting with the
+        base frequency given by baud. Only chunks which describe tape
+        signals and silence contribute to the time."""
+
+        if chunks == None:
+            chunks = self.chunks
+
+        base = float(baud)
+        # The number of cycles of the base frequency used for each data bit
+        bit_cycles = 1.0
+        seconds = 0.0
+
+        for chunk_id, data in chunks:
+
+            if chunk_id == 0x100:
+                # Implicit start and stop bits
+                seconds = seconds + len(data) * 10 * bit_cycles / base
+
+            elif chunk_id == 0x102:
+                if len(data) > 0:
+                    bits = (len(data) - 1) * 8 - ord(data[0])
+                    seconds = seconds + bits * bit_cycles / base
+
+            elif chunk_id == 0x104:
+                if len(data) >= 3:
+                    bits = ord(data[0]) + 1 + abs(struct.unpack('<b', data[2])[0])
+                    if data[1] != 'N':
+                        bits = bits + 1
+                    seconds = seconds + (len(data) - 3) * bits * bit_cycles / base
+
+            elif chunk_id == 0x110 or chunk_id == 0x112:
+                # Carrier tones and gaps in cycles at twice the base frequency
+                seconds = seconds + self.read_timing_chunk((chunk_id, data)) / (2 * base)
+
+            elif chunk_id == 0x111:
+                # Carrier tone with a dummy byte
+                before, after = struct.unpack('<HH', data[:4])
+                seconds = seconds + (before + after) / (2 * base) + 10 * bit_cycles / base
+
+            elif chunk_id == 0x113:
+                base = self.read_timing_chunk((chunk_id, data))
+
+            elif chunk_id == 0x114:
+                cycles = struct.unpack('<I', data[:3] + '\000')[0]
+                seconds = seconds + cycles / base
+
+            elif chunk_id == 0x116:
+                seconds = seconds + self.read_timing_chunk((chunk_id, data))
+
+            elif chunk_id == 0x117:
+                # Data encoding format change between 300 and 1200 baud
+                bit_cycles = 1200.0 / self.read_timing_chunk((chunk_id, data))
+
+        return seconds
+
+
+    def shorten_gaps(self, file_gap = min_file_gap, file_tone = min_file_tone,
+                     block_tone = min_block_tone):
+        """
+        Shorten the gaps and carrier tones before each file block so that
+        the total gap before the first block of each file is no longer than
+        file_gap and the total carrier tone before it is no longer than
+        file_tone, and the carrier tone before each of the other blocks is
+        no longer than block_tone, all given in cycles at twice the base
+        frequency.
+
+        The tones nearest each block are kept in preference to earlier ones.
+        Chunks are shortened instead of being removed so that the positions
+        of the files in the list of chunks do not change.
+        """
+
+        if isinstance(self.chunks, ChunkTable):
+            self.chunks = ChunkList(self.chunks[:])
+
+        base = 1200.0
+        pending = []
+
+        for pos in range(len(self.chunks)):
+
+            chunk_id, data = self.chunks[pos]
+
+            if chunk_id == 0x113:
+                base = self.read_timing_chunk((chunk_id, data))
+
+            elif chunk_id in (0x110, 0x112, 0x116):
+                pending.append(pos)
+
+            elif self.is_block(self.chunks[pos]):
+
+                try:
+                    first = self.read_block(self.chunks[pos])[4] == 0
+                except IndexError:
+                    first = False
+
+                if first:
+                    gap, tone = file_gap, file_tone
+                else:
+                    gap, tone = 0, block_tone
+
+                # Shorten the chunks nearest the block last
+                pending.reverse()
+
+                for i in pending:
+
+                    chunk_id = self.chunks[i][0]
+                    length = self.read_timing_chunk(self.chunks[i])
+
+                    if chunk_id == 0x116:
+                        new_length = min(length, gap / (2 * base))
+                        gap = gap - int(new_length * 2 * base)
+                    elif chunk_id == 0x110:
+                        new_length = min(length, tone)
+                        tone = tone - new_length
+                    else:
+                        new_length = min(length, gap)
+                        gap = gap - new_length
+
+                    if new_length < length:
+                        self.chunks[i] = self.timing_chunk(chunk_id, new_length)
+
+                pending = []
+
+            elif chunk_id not in (0x100, 0x102, 0x111, 0x114, 0x115, 0x117):
+                # Gaps and tones before other data are left unchanged, but
+                # dummy bytes and other signals between the tones before a
+                # block are allowed
+                pending = []
+
+
     def read_uef_details(self):
         """Return details about the UEF file and its contents."""
 
@@ -597,15 +2606,15 @@ class UEFfile:
 
             self.creator = 'Unknown'
 
-        elif chunk[1] == '':
+        elif len(chunk[1]) == 0:
 
             self.creator = 'Unknown'
         else:
-            self.creator = chunk[1]
+            self.creator = str(chunk[1])
 
         # Delete the creator chunk
         if pos != None:
-            del self.chunks[pos]
+            self.delete_chunk(pos)
 
         # Find the target machine chunk
         pos, chunk = self.find_next_chunk(0, [0x5])
@@ -633,7 +2642,7 @@ class UEFfile:
                 self.keyboard_layout = 'Unknown'
 
             # Delete the target machine chunk
-            del self.chunks[pos]
+            self.delete_chunk(pos)
 
         # Find the emulator chunk
         pos, chunk = self.find_next_chunk(0, [0xff00])
@@ -642,15 +2651,15 @@ class UEFfile:
 
             self.emulator = 'Unspecified'
 
-        elif chunk[1] == '':
+        elif len(chunk[1]) == 0:
 
             self.emulator = 'Unknown'
         else:
-            self.emulator = chunk[1]
+            self.emulator = str(chunk[1])
 
         # Delete the emulator chunk
         if pos != None:
-            del self.chunks[pos]
+            self.delete_chunk(pos)
 
         # Remove trailing null bytes
         while len(self.creator) > 0 and self.creator[-1] == '\000':
@@ -683,18 +2692,29 @@ class UEFfile:
     def write_uef_creator(self, file):
         """Write a creator chunk to a file."""
 
+        self.chunk(file, *self.creator_chunk())
+
+
+    def creator_chunk(self):
+        """Return a creator chunk."""
+
         origin = self.creator + '\000'
 
         if (len(origin) % 4) != 0:
             origin = origin + ('\000'*(4-(len(origin) % 4)))
 
-        # Write the creator chunk
-        self.chunk(file, 0, origin)
+        return (0, origin)
 
 
     def write_machine_info(self, file):
         """Write the target machine and keyboard layout information to a file."""
 
+        self.chunk(file, *self.machine_chunk())
+
+
+    def machine_chunk(self):
+        """Return a chunk describing the target machine and keyboard layout."""
+
         machines = {'BBC Model A': 0, 'Electron': 1, 'BBC Model B': 2, 'BBC Master':3}
         keyboards = {'any': 0, 'physical': 1, 'logical': 2}
 
@@ -706,23 +2726,28 @@ class UEFfile:
 
         if keyboards.has_key(self.keyboard_layout):
 
-            keyboard = keyboards[keyboard_layout]
+            keyboard = keyboards[self.keyboard_layout]
         else:
             keyboard = 0
 
-        self.chunk(file, 5, self.number(1, machine | (keyboard << 4) ))
+        return (5, self.number(1, machine | (keyboard << 4) ))
 
 
     def write_emulator_info(self, file):
         """Write an emulator chunk to a file."""
 
+        self.chunk(file, *self.emulator_chunk())
+
+
+    def emulator_chunk(self):
+        """Return an emulator chunk."""
+
         emulator = self.emulator + '\000'
 
         if (len(emulator) % 4) != 0:
             emulator = emulator + ('\000'*(4-(len(emulator) % 4)))
 
-        # Write the creator chunk
-        self.chunk(file, 0xff00, emulator)
+        return (0xff00, emulator)
 
 
     def write_chunks(self, file):
@@ -737,40 +2762,33 @@ class UEFfile:
         """Create suitable chunks, and insert them into
         the list of chunks."""
 
-        # Reset the block number to zero
-        block_number = 0
-
-        # Long gap
-        gap = 1
-
         new_chunks = []
-    
-        # Write block details
-        while 1:
-            block, last = self.write_block(data[:256], name, load, exe, block_number)
 
-            # Remove the leading 256 bytes as they have been encoded
-            data = data[256:]
-
-            if gap == 1:
-                new_chunks.append((0x110, self.number(2,0x00f0)))
-                gap = 0
-            else:
-                new_chunks.append((0x110, self.number(2,0x0078)))
+        # Precede the first block with a long gap and the others with short
+        # gaps
+        gap = long_gap
 
-            # Write the block to the list of new chunks
-            new_chunks.append((0x100, block))
+        for block in block_codec.encode_blocks(name, load, exe, data):
 
-            if last == 1:
-                break
+            new_chunks.append((0x110, gap))
+            gap = short_gap
 
-            # Increment the block number
-            block_number = block_number + 1
+            # Write the block to the list of new chunks
+            new_chunks.append((0x100, str(block)))
 
         # Return the list of new chunks
         return new_chunks
 
 
+    def encode_blocks(self, name, load, exe, data):
+        """Encode file data as a list of data blocks, as would be created by
+        calling write_block for each 256 byte piece of the data. The blocks
+        are written to a single bytearray and returned as buffers referring
+        to it."""
+
+        return block_codec.encode_blocks(name, load, exe, data)
+
+
     def import_files(self, file_position, info):
         """
         Import a file into the UEF file at the specified location in the
@@ -821,18 +2839,106 @@ class UEFfile:
             info = [info]
 
         # Read the file details for each file and create chunks to add
-        # to the list of chunks
+        # to the list of chunks, recording the details of each file for
+        # the contents list
         inserted_chunks = []
+        inserted_contents = []
 
         for name, load, exe, data in info:
 
-            inserted_chunks = inserted_chunks + self.create_chunks(name, load, exe, data)
+            new_chunks = self.create_chunks(name, load, exe, data)
+
+            # Each file starts with a non-block chunk and ends with a block,
+            # and its name is read from a block as it would be by read_block
+            inserted_contents.append(FileRecord(self,
+                string.split(name[:10], '\000')[0],
+                load & 0xffffffff, exe & 0xffffffff, len(data)/256,
+                position + len(inserted_chunks),
+                position + len(inserted_chunks) + len(new_chunks) - 1))
+
+            inserted_chunks.extend(new_chunks)
+
+        # If the chunks are inserted before a block then the existing blocks
+        # may be read differently, so the contents list must be rebuilt
+        if position < len(self.chunks) and self.is_block(self.chunks[position]):
+            rebuild = True
+        else:
+            rebuild = False
 
         # Insert the chunks in the list at the specified position
-        self.chunks = self.chunks[:position] + inserted_chunks + self.chunks[position:]
+        self.insert_chunks([(position, inserted_chunks)])
 
         # Update the contents list
-        self.read_contents()
+        if rebuild:
+            self.read_contents()
+        else:
+            self.insert_contents(position, inserted_contents)
+
+
+    def insert_chunks(self, insertions):
+        """Insert chunks at a number of positions in the list of chunks.
+        insertions is a list of (position, chunks) tuples, where each position
+        refers to the list before any chunks are inserted. Chunks inserted at
+        the same position are kept in the order given.
+
+        The new list of chunks is built in a single pass, and the chunk index
+        and the positions of the files in the contents list are updated to
+        account for the inserted chunks."""
+
+        # Sort the insertions by position, keeping insertions at the same
+        # position in order
+        insertions = sorted(insertions, key = lambda item: item[0])
+
+        if insertions and (insertions[0][0] < 0 or insertions[-1][0] > len(self.chunks)):
+            raise UEFfile_error, 'Chunk positions must be within the list of chunks.'
+
+        new_chunks = ChunkList()
+        start = 0
+        for position, chunks in insertions:
+
+            new_chunks.extend(self.chunks[start:position])
+            new_chunks.extend(chunks)
+            start = position
+
+        new_chunks.extend(self.chunks[start:])
+
+        # Overwrite the chunks list with the new list
+        self.chunk_index()
+        self.chunks = new_chunks
+        self.index_inserted(map(lambda item: (item[0], map(lambda chunk: chunk[0], item[1])),
+                                insertions))
+
+        # Move the files in the contents list, including any files with
+        # chunks inserted between their first and last chunks
+        starts = map(lambda item: item[0], insertions)
+        inserted_before = [0]
+        for position, chunks in insertions:
+            inserted_before.append(inserted_before[-1] + len(chunks))
+
+        for details in self.contents:
+
+            details.position = details.position + \
+                inserted_before[bisect.bisect_right(starts, details.position)]
+            details.last_position = details.last_position + \
+                inserted_before[bisect.bisect_right(starts, details.last_position)]
+
+
+    def insert_contents(self, position, inserted_contents):
+        """Update the contents list after chunks have been inserted at the
+        chunk position specified, inserting the list of contents entries for
+        any files they contain before the files that follow them."""
+
+        before = []
+        after = []
+
+        for details in self.contents:
+
+            if details.position >= position:
+                after.append(details)
+            else:
+                before.append(details)
+
+        self.contents = before + inserted_contents + after
 
 
     def chunk_number(self, name):
@@ -898,6 +3004,83 @@ class UEFfile:
         return info
 
 
+    def extract_files(self, directory, file_positions = None):
+        """
+        Write the files at the given locations in the list of contents to
+        the specified directory, or all the files if file_positions is None.
+        Each file's data is written one block at a time, so only one block
+        is held in memory at once when the chunks are read lazily.
+
+        Each file is accompanied by a file with the same name and an "inf"
+        suffix containing the file's name, load and execution addresses and
+        length, with the name quoted if necessary by inf_name. Characters
+        which cannot be used in file names are replaced and files with the
+        same name are given numbered names.
+
+        Returns a list of the paths of the files written.
+        """
+
+        if file_positions == None:
+            file_positions = range(len(self.contents))
+        elif type(file_positions) == types.IntType:
+            file_positions = [file_positions]
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                raise UEFfile_error, "Couldn't create the directory %s." % directory
+
+        used = {}
+        paths = []
+
+        for file_position in file_positions:
+
+            if file_position < 0 or file_position >= len(self.contents):
+
+                raise UEFfile_error, 'File position %i does not correspond to an actual file.' % file_position
+
+            details = self.contents[file_position]
+
+            # Find a name for the file which has not been used
+            name = details.name
+            for c in (os.sep, '/', '\\', ':', '\000'):
+                name = name.replace(c, '_')
+            name = name or 'UNNAMED'
+
+            leafname = name
+            n = 1
+            while used.has_key(leafname.lower()):
+                leafname = '%s_%i' % (name, n)
+                n = n + 1
+
+            used[leafname.lower()] = None
+            path = os.path.join(directory, leafname)
+
+            try:
+                f = open(path, 'wb')
+                length = 0
+
+                try:
+                    for data in self.iter_file_data(details):
+                        f.write(data)
+                        length = length + len(data)
+                finally:
+                    f.close()
+
+                f = open(path + suffix + 'inf', 'w')
+                f.write('%s %08X %08X %08X\n' % (inf_name(details.name), details.load & 0xffffffff,
+                        details.exec_addr & 0xffffffff, length))
+                f.close()
+
+            except IOError:
+                raise UEFfile_error, "Couldn't write the file %s." % path
+
+            paths.append(path)
+
+        return paths
+
+
     def chunk_name(self, number):
         """
         Returns the relevant chunk name for the number given.
@@ -927,7 +3110,8 @@ class UEFfile:
 
             file_positions = [file_positions]
 
-        positions = []
+        ranges = []
+        removed = []
         for file_position in file_positions:
     
             # Find the chunk position which corresponds to the file position
@@ -936,22 +3120,87 @@ class UEFfile:
                 print 'File position %i does not correspond to an actual file.' % file_position
     
             else:
-                # Add the chunk positions within each file to the list of positions
-                positions = positions + range(self.contents[file_position]['position'],
-                                  self.contents[file_position]['last position'] + 1)
+                # Add the range of chunk positions within each file to the list of ranges
+                details = self.contents[file_position]
+                ranges.append((details.position, details.last_position))
+                removed.append(file_position)
     
-        # Create a new list of chunks without those in the positions list
-        new_chunks = []
-        for c in range(0, len(self.chunks)): 
-    
-            if c not in positions:
-                new_chunks.append(self.chunks[c])
+        # Create a new list of chunks without those in the ranges, copying
+        # the chunks between the ranges in a single pass, and merge any
+        # overlapping ranges
+        ranges.sort()
+
+        new_chunks = ChunkList()
+        merged = []
+        start = 0
+        for first, last in ranges:
+
+            if first > start:
+                new_chunks.extend(self.chunks[start:first])
+
+            if first >= start:
+                merged.append((first, last))
+            else:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+
+            start = max(start, last + 1)
+
+        new_chunks.extend(self.chunks[start:])
 
         # Overwrite the chunks list with this new list
+        self.chunk_index()
         self.chunks = new_chunks
+        self.index_removed(merged)
+
+        # Update the contents list
+        self.remove_contents(removed)
+
+
+    def remove_contents(self, removed):
+        """Update the contents list after the chunks of the files at the
+        positions in the removed list have been removed from the list of
+        chunks."""
+
+        removed = set(removed)
+
+        # Find the ranges of chunks that were removed
+        ranges = []
+        for file_position in removed:
+
+            details = self.contents[file_position]
+            ranges.append((details.position, details.last_position))
+
+        ranges.sort()
 
-        # Create a new contents list
-        self.read_contents()        
+        contents = []
+        shift = 0
+        r = 0
+
+        for file_position in range(len(self.contents)):
+
+            if file_position in removed:
+                continue
+
+            details = self.contents[file_position]
+
+            # Count the chunks removed before this file
+            while r < len(ranges) and ranges[r][1] < details.position:
+
+                shift = shift + ranges[r][1] - ranges[r][0] + 1
+                r = r + 1
+
+            if r < len(ranges) and ranges[r][0] <= details.last_position:
+
+                # Some of the chunks removed overlapped with this file, so
+                # the contents list must be rebuilt
+                self.read_contents()
+                return
+
+            details.position = details.position - shift
+            details.last_position = details.last_position - shift
+            contents.append(details)
+
+        self.contents = contents
 
 
     def printable(self, s):
@@ -1123,3 +3372,117 @@ class UEFfile:
             n = n + 1
 
         print
+
+
+def read_index(filename):
+    """index = read_index(filename)
+
+    Read the index written alongside the UEF file with the specified
+    filename, returning a dictionary containing its contents, or None if
+    there is no index or it does not describe the file as it is now.
+    """
+
+    try:
+        f = open(filename + suffix + 'idx', 'r')
+        try:
+            index = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+    if index.get('version') != 2 or index.get('size') != os.path.getsize(filename) or \
+       index.get('mtime') != os.path.getmtime(filename):
+        return None
+
+    return index
+
+
+def inf_name(name):
+    """Return a file name in the form used in .inf files. Names that are
+    empty or contain spaces, control characters, quotes or percent signs
+    are enclosed in double quotes, and any characters in them other than
+    printable ASCII characters and spaces are written as a percent sign
+    followed by two hexadecimal digits."""
+
+    quoted = name == ''
+    escaped = []
+
+    for c in name:
+
+        if c == ' ':
+            quoted = True
+        elif c <= ' ' or c > '~' or c == '"' or c == '%':
+            c = '%%%02X' % ord(c)
+            quoted = True
+
+        escaped.append(c)
+
+    if quoted:
+        return '"' + ''.join(escaped) + '"'
+
+    return name
+
+
+def replace_file(new_filename, filename):
+    """Replace the file with the specified filename with the file called
+    new_filename. An open or mapped file that is replaced can still be
+    read on platforms that allow this."""
+
+    try:
+        os.rename(new_filename, filename)
+    except OSError:
+        # Some platforms do not allow an existing file to be replaced
+        os.remove(filename)
+        os.rename(new_filename, filename)
+
+
+def write_files(items, threads = None, update = False, **options):
+    """write_files(items, threads, update, ...)
+
+    Write each UEFfile instance in a list of (instance, filename) tuples to
+    the file with the corresponding filename, using a pool with the given
+    number of threads to write the files at the same time. If update is True
+    then existing files are updated using the update method of each instance
+    instead of being written again. Any other keyword arguments are passed
+    to the write or update method of each instance.
+    """
+
+    pool = ThreadPool(threads)
+
+    if update:
+        method = UEFfile.update
+    else:
+        method = UEFfile.write
+
+    try:
+        pool.map(lambda item: method(item[0], item[1], **options), items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def check_blocks(chunks):
+    """results = check_blocks(chunks)
+
+    Check the CRCs of the blocks in a list of tape chunks, returning a list
+    of (block number, header CRC is correct, data CRC is correct) tuples.
+    The block number is None if the block header could not be read.
+    This is used by UEFfile.verify to check blocks in other processes.
+    """
+
+    u = UEFfile()
+    results = []
+
+    for chunk in chunks:
+
+        header_ok, data_ok = u.check_block(chunk)
+
+        try:
+            block_number = u.read_block(chunk)[4]
+        except IndexError:
+            block_number = None
+
+        results.append((block_number, header_ok, data_ok))
+
+    return results
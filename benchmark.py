@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2011 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip, json, os, random, shutil, subprocess, sys, tempfile, time
+import UEFfile, uefstore
+
+def random_data(length, seed = 0):
+
+    r = random.Random(seed)
+    return "".join(map(lambda i: chr(r.randint(0, 255)), range(length)))
+
+def timed(function, *args):
+
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+def bench_crc():
+
+    u = UEFfile.UEFfile()
+    data = random_data(65536)
+    
+    bitwise_time, bitwise_crc = timed(u.bitwise_crc, data)
+    table_time, table_crc = timed(u.crc, data)
+    
+    if bitwise_crc != table_crc:
+        sys.stderr.write("CRC mismatch: %04x (bitwise) != %04x (table)\n" % (
+            bitwise_crc, table_crc))
+        sys.exit(1)
+    
+    # Compare the batched CRCs with those in the blocks made by write_block.
+    batch_time, crcs = timed(u.block_crcs, "BENCH", 0x1900, 0x8023, data)
+    
+    for block_number in range(len(crcs)):
+    
+        block = data[block_number*256:(block_number+1)*256]
+        out, last = u.write_block(block, "BENCH", 0x1900, 0x8023, block_number)
+        header_crc = u.str2num(2, out[len(out)-len(block)-4:])
+        data_crc = u.str2num(2, out[-2:])
+        
+        if crcs[block_number] != (header_crc, data_crc):
+            sys.stderr.write("Block CRC mismatch in block %i\n" % block_number)
+            sys.exit(1)
+    
+    print "CRC of %i bytes" % len(data)
+    print "  bitwise:      %8.4f s" % bitwise_time
+    print "  table:        %8.4f s (%.0fx)" % (table_time, bitwise_time/max(table_time, 1e-9))
+    print "  batch blocks: %8.4f s (%i blocks)" % (batch_time, len(crcs))
+
+def encode_defined(data):
+
+    """Encodes data as the contents of a defined tape format chunk (0x102)
+    with a start and stop bit around each byte."""
+    
+    bits = []
+    for c in data:
+        bits.append(0)
+        value = ord(c)
+        for i in range(8):
+            bits.append((value >> i) & 1)
+        bits.append(1)
+    
+    ignore = (8 - (len(bits) % 8)) % 8
+    bits += [0] * ignore
+    
+    encoded = [chr(ignore)]
+    for i in range(0, len(bits), 8):
+        value = 0
+        for j in range(8):
+            value |= bits[i + j] << j
+        encoded.append(chr(value))
+    
+    return "".join(encoded)
+
+def bench_defined():
+
+    u = UEFfile.UEFfile()
+    data = random_data(65536)
+    
+    implicit = []
+    defined = []
+    for block_number in range(len(data)/256 + 1):
+        block, last = u.write_block(data[block_number*256:(block_number+1)*256],
+                                    "BENCH", 0x1900, 0x8023, block_number)
+        implicit.append((0x100, block))
+        defined.append((0x102, encode_defined(block)))
+    
+    expected = map(u.read_block, implicit)
+    numpy = UEFfile.numpy
+    
+    for label, module in (("numpy", numpy), ("python", None)):
+    
+        if label == "numpy" and numpy == None:
+            print "0x102 decoding (numpy): not available"
+            continue
+        
+        UEFfile.numpy = module
+        try:
+            decode_time, decoded = timed(map, u.read_block, defined)
+        finally:
+            UEFfile.numpy = numpy
+        
+        if decoded != expected:
+            sys.stderr.write("Decoded 0x102 chunks differ from 0x100 chunks (%s)\n" % label)
+            sys.exit(1)
+        
+        print "0x102 decoding of %i blocks (%s): %8.4f s" % (len(defined), label, decode_time)
+
+def bench_remove():
+
+    # Create an archive of 25000 small files, each using two chunks.
+    u = UEFfile.UEFfile()
+    files = []
+    for i in range(25000):
+        files.append(("F%i" % i, 0x1900, 0x8023, chr(i & 0xff) * 16))
+    
+    u.import_files(0, files)
+    chunks = u.chunks
+    
+    # Remove every 25th file.
+    remove = range(0, len(files), 25)
+    positions = []
+    for file_position in remove:
+        details = u.contents[file_position]
+        positions += range(details["position"], details["last position"] + 1)
+    
+    # Filter the chunks using list membership tests, as remove_files used to.
+    def filter_chunks():
+        new_chunks = []
+        for c in range(0, len(chunks)):
+            if c not in positions:
+                new_chunks.append(chunks[c])
+        return new_chunks
+    
+    list_time, expected = timed(filter_chunks)
+    remove_time, result = timed(u.remove_files, remove)
+    
+    if u.chunks != expected or len(u.contents) != len(files) - len(remove):
+        sys.stderr.write("remove_files produced a different list of chunks\n")
+        sys.exit(1)
+    
+    print "Removing %i files from %i chunks" % (len(remove), len(chunks))
+    print "  list membership filter: %8.4f s" % list_time
+    print "  remove_files:           %8.4f s" % remove_time
+
+def bench_encode():
+
+    u = UEFfile.UEFfile()
+    
+    # Encode blocks by slicing the data and calling write_block, as
+    # create_chunks used to.
+    def write_blocks(data):
+        blocks = []
+        block_number = 0
+        while 1:
+            block, last = u.write_block(data[:256], "BENCH", 0x1900, 0x8023, block_number)
+            data = data[256:]
+            blocks.append(block)
+            if last == 1:
+                break
+            block_number += 1
+        return blocks
+    
+    sample = random_data(65536)
+    
+    for size in (32768, 1048576):
+    
+        data = (sample * (size / len(sample) + 1))[:size]
+        
+        write_time, expected = timed(write_blocks, data)
+        encode_time, encoded = timed(u.encode_blocks, "BENCH", 0x1900, 0x8023, data)
+        
+        if map(str, encoded) != expected:
+            sys.stderr.write("encode_blocks produced different blocks\n")
+            sys.exit(1)
+        
+        print "Encoding %i bytes as %i blocks" % (size, len(encoded))
+        print "  write_block:   %8.4f s" % write_time
+        print "  encode_blocks: %8.4f s" % encode_time
+
+def bench_gzip():
+
+    # Create an archive of about 8 MB from files made of a repeated sample.
+    sample = random_data(65536)
+    u = UEFfile.UEFfile()
+    files = []
+    for i in range(128):
+        files.append(("F%i" % i, 0x1900, 0x8023, sample[i*256:] + sample[:i*256]))
+    
+    u.import_files(0, files)
+    size = len(files) * len(sample)
+    
+    path = "benchmark.uef"
+    
+    print "Writing %i bytes of file data (%i chunks)" % (size, len(u.chunks))
+    
+    for label, threads in (("gzip", None), ("1 worker", 1), ("2 workers", 2),
+                           ("4 workers", 4), ("8 workers", 8)):
+    
+        write_time, result = timed(u.write, path, True, True, True, 6, threads)
+        
+        if len(UEFfile.UEFfile(path).contents) != len(files):
+            sys.stderr.write("Failed to read the file written (%s)\n" % label)
+            sys.exit(1)
+        
+        print "  %-10s %8.4f s (%.1f MB/s)" % (label, write_time, size/write_time/1048576)
+    
+    os.remove(path)
+
+def bench_lazy():
+
+    # Write an archive of 2000 small files, compressed and uncompressed, and
+    # compare the time taken to open it eagerly, lazily and mapped.
+    u = UEFfile.UEFfile()
+    files = []
+    for i in range(2000):
+        files.append(("F%i" % i, 0x1900, 0x8023, random_data(300, i)))
+    
+    u.import_files(0, files)
+    
+    for label, path, compresslevel in (("raw", "benchmark-raw.uef", None),
+                                       ("gzip", "benchmark-gzip.uef", 9)):
+        try:
+            u.write(path, True, True, True, compresslevel)
+            
+            print "Opening %i files (%s)" % (len(files), label)
+            for mode, options in (("eager", {}), ("lazy", {"lazy": True}),
+                                  ("mapped", {"mapped": True})):
+            
+                open_time, v = timed(lambda: UEFfile.UEFfile(path, **options))
+                if len(v.contents) != len(files):
+                    sys.stderr.write("Failed to read the file written (%s, %s)\n" % (label, mode))
+                    sys.exit(1)
+                v.close()
+                
+                print "  %-7s %8.4f s" % (mode + ":", open_time)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+def bench_store():
+
+    # Create 200 builds that share their title, sprite and character data,
+    # changing a few bytes of the code in each build and the characters in
+    # every twentieth build.
+    title = random_data(0x2400, 1)
+    sprites = random_data(0x360, 2)
+    chars = random_data(0x1280, 3)
+    code = random_data(0x2000, 4)
+    r = random.Random(5)
+    
+    directory = tempfile.mkdtemp()
+    paths = []
+    
+    for i in range(200):
+    
+        position = r.randint(0, len(code) - 4)
+        code = code[:position] + random_data(4, i) + code[position + 4:]
+        if i % 20 == 19:
+            chars = random_data(len(chars), i)
+        
+        u = UEFfile.UEFfile(creator = "benchmark")
+        u.import_files(0, [("TITLE", 0x5aa0, 0x5aa0, title),
+                           ("SPRITES", 0x5400, 0x5400, sprites),
+                           ("CHARS", 0x3f00, 0x3f00, chars),
+                           ("CODE", 0x1e00, 0x1e00, code)])
+        
+        path = os.path.join(directory, "build%03i.uef" % i)
+        u.write(path)
+        paths.append(path)
+    
+    try:
+        store = uefstore.BlockStore(os.path.join(directory, "store"))
+        
+        manifests = []
+        import_time, result = timed(map, lambda path: uefstore.import_uef(store, path), paths)
+        manifests += result
+        store.flush()
+        
+        for path, manifest in zip(paths, manifests)[::50]:
+            uefstore.export_uef(store, manifest, path + ".new")
+            if gzip.open(path).read() != gzip.open(path + ".new").read():
+                sys.stderr.write("Rebuilt %s differs from the original\n" % path)
+                sys.exit(1)
+        
+        store.close()
+        
+        uef_size = sum(map(os.path.getsize, paths))
+        store_size = os.path.getsize(os.path.join(directory, "store", "pack")) + \
+                     os.path.getsize(os.path.join(directory, "store", "index"))
+        manifest_size = sum(map(lambda manifest: len(json.dumps(manifest)), manifests))
+    finally:
+        shutil.rmtree(directory)
+    
+    print "Storing %i builds (%i compressed bytes)" % (len(paths), uef_size)
+    print "  import:    %8.4f s" % import_time
+    print "  store:     %8i bytes (%i objects)" % (store_size, len(store.objects))
+    print "  manifests: %8i bytes" % manifest_size
+    print "  saved:     %8.1f%%" % (100.0 * (1 - float(store_size + manifest_size) / uef_size))
+
+def bench_wav():
+
+    # The renderer and demodulator need NumPy.
+    try:
+        import uefwav
+    except ImportError:
+        print "WAV rendering: not available"
+        return
+    
+    # Create a tape laid out like the one made by build.py, with gaps and
+    # padding before each file.
+    u = UEFfile.UEFfile()
+    files = []
+    for i, length in enumerate((600, 700, 0x2400, 0x360, 0x1280, 0x2200)):
+        files.append(("F%i" % i, 0x1900, 0x8023, random_data(length, i)))
+    
+    u.import_files(0, files)
+    for details in reversed(u.contents):
+        position = details["position"]
+        u.chunks[position:position] = [(0x112, "\xdc\x05"), (0x110, "\xdc\x05"), (0x100, "\xdc")]
+    u.read_contents()
+    
+    path = "benchmark.wav"
+    
+    try:
+        render_time, result = timed(uefwav.render, u, path)
+        decode_time, decoded = timed(uefwav.demodulate, path)
+    finally:
+        os.remove(path)
+    
+    original = [str(data) for chunk_id, data in u.chunks if chunk_id == 0x100]
+    found = [str(data) for chunk_id, data in decoded.chunks if chunk_id == 0x100]
+    
+    if found != original or decoded.verify():
+        sys.stderr.write("The decoded data chunks differ from the original ones\n")
+        sys.exit(1)
+    
+    print "WAV round trip of %.1f s of tape" % u.tape_time()
+    print "  render:     %8.4f s" % render_time
+    print "  demodulate: %8.4f s" % decode_time
+
+def synthetic_files(chunks, seed = 0):
+
+    # Create a list of files which are encoded as about the number of chunks
+    # given, with two chunks for each block.
+    r = random.Random(seed)
+    sample = random_data(65536, seed)
+    files = []
+    total = 0
+    
+    while total < chunks:
+        length = r.randint(0, 2047)
+        start = r.randint(0, len(sample) - length)
+        files.append(("F%i" % len(files), 0x1900, 0x8023, sample[start:start + length]))
+        total += 2 * (length / 256 + 1)
+    
+    return files
+
+# Opens a UEF file in a new process, reporting the time taken, the peak
+# memory use in kilobytes and the number of files found. On Linux the peak
+# resident set size reported by getrusage includes that of the parent
+# process, which is preserved when the new program is executed, so the
+# peak for the new program is read from /proc where possible.
+parse_script = """
+import resource, sys, time
+import UEFfile
+start = time.time()
+u = UEFfile.UEFfile(sys.argv[1], **dict(map(lambda option: (option, True), sys.argv[2:])))
+elapsed = time.time() - start
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    for line in open('/proc/self/status'):
+        if line.startswith('VmHWM:'):
+            maxrss = int(line.split()[1])
+except IOError:
+    pass
+print elapsed, maxrss, len(u.contents)
+"""
+
+def parse_in_process(path, options):
+
+    # Parse the file in a separate interpreter so that its peak memory use
+    # is not affected by the memory already used by this process.
+    output = subprocess.Popen([sys.executable, "-c", parse_script, path] + options,
+                              stdout = subprocess.PIPE,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    elapsed, maxrss, files = output.split()
+    return float(elapsed), int(maxrss), int(files)
+
+def bench_suite(output = None):
+
+    # Time the main UEFfile operations on synthetic tapes of increasing size,
+    # writing the results to a JSON file if an output file is given. Files
+    # are also parsed lazily and mapped in separate processes, recording
+    # their peak memory use as well as the time taken.
+    raw_path = "benchmark-raw.uef"
+    gzip_path = "benchmark-gzip.uef"
+    seed = 1
+    results = []
+    
+    print "%8s %8s" % ("chunks", "files"),
+    operations = ("import_files", "write", "write_gzip", "parse", "parse_gzip",
+                  "read_contents", "export_files", "remove_files")
+    parse_modes = (("parse", raw_path, []), ("parse_gzip", gzip_path, []),
+                   ("parse_lazy", raw_path, ["lazy"]),
+                   ("parse_gzip_lazy", gzip_path, ["lazy"]),
+                   ("parse_mapped", raw_path, ["mapped"]),
+                   ("parse_gzip_mapped", gzip_path, ["mapped"]))
+    memory_table = []
+    for operation in operations:
+        print "%13s" % operation,
+    print
+    
+    try:
+        for size in (10, 100, 1000, 10000, 100000):
+        
+            files = synthetic_files(size, seed)
+            times = {}
+            
+            u = UEFfile.UEFfile(creator = "benchmark")
+            times["import_files"] = timed(u.import_files, 0, files)[0]
+            times["write"] = timed(u.write, raw_path, True, True, True, None)[0]
+            times["write_gzip"] = timed(u.write, gzip_path)[0]
+            
+            times["parse"], v = timed(UEFfile.UEFfile, raw_path)
+            times["parse_gzip"] = timed(UEFfile.UEFfile, gzip_path)[0]
+            times["read_contents"] = timed(v.read_contents)[0]
+            
+            times["export_files"], exported = timed(v.export_files, range(len(v.contents)))
+            if len(files) == 1:
+                exported = [exported]
+            
+            if map(lambda info: str(info[3]), exported) != map(lambda info: info[3], files):
+                sys.stderr.write("Exported files differ from the imported ones (%i chunks)\n" % size)
+                sys.exit(1)
+            
+            times["remove_files"] = timed(v.remove_files, range(0, len(files), 10))[0]
+            
+            # Parse the files in each mode in separate processes.
+            process_times = {}
+            memory = {}
+            for mode, path, options in parse_modes:
+            
+                process_times[mode], memory[mode], found = parse_in_process(path, options)
+                if found != len(files):
+                    sys.stderr.write("Failed to parse the file written (%s, %i chunks)\n" % (mode, size))
+                    sys.exit(1)
+            
+            memory_table.append((len(u.chunks), memory))
+            
+            result = {"chunks": len(u.chunks), "files": len(files),
+                      "bytes": os.path.getsize(raw_path),
+                      "gzip bytes": os.path.getsize(gzip_path),
+                      "times": times, "process times": process_times,
+                      "peak memory": memory}
+            results.append(result)
+            
+            print "%8i %8i" % (len(u.chunks), len(files)),
+            for operation in operations:
+                print "%13.4f" % times[operation],
+            print
+    finally:
+        for path in (raw_path, gzip_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    # Show the peak memory used when parsing in each mode.
+    print
+    print "%8s" % "chunks",
+    for mode, path, options in parse_modes:
+        print "%17s" % mode,
+    print
+    
+    for chunks, memory in memory_table:
+        print "%8i" % chunks,
+        for mode, path, options in parse_modes:
+            print "%14.1f MB" % (memory[mode] / 1024.0),
+        print
+    
+    if output:
+        f = open(output, "w")
+        json.dump({"version": 2, "seed": seed, "python": sys.version.split()[0],
+                   "UEFfile": UEFfile.version, "results": results}, f, indent = 1)
+        f.close()
+        
+        print "Written", output
+
+benchmarks = {"crc": bench_crc, "defined": bench_defined, "encode": bench_encode,
+              "gzip": bench_gzip, "lazy": bench_lazy, "remove": bench_remove,
+              "store": bench_store, "suite": bench_suite, "wav": bench_wav}
+
+if __name__ == "__main__":
+
+    names = sys.argv[1:]
+    
+    # The suite benchmark writes its results to a JSON file if one is given.
+    output = None
+    usage = False
+    if "-o" in names:
+        i = names.index("-o")
+        if i + 1 < len(names):
+            output = names[i + 1]
+        else:
+            usage = True
+        del names[i:i + 2]
+    
+    if not names:
+        names = sorted(benchmarks.keys())
+    
+    for name in names:
+    
+        if not benchmarks.has_key(name) or usage:
+            sys.stderr.write("Usage: %s [-o <JSON file>] [%s]...\n" % (
+                sys.argv[0], "|".join(sorted(benchmarks.keys()))))
+            sys.exit(1)
+        
+        if name == "suite":
+            bench_suite(output)
+        else:
+            benchmarks[name]()
+    
+    sys.exit()
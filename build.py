@@ -102,7 +102,57 @@ def decode_text(data, lookup):
     
     return words[:-1]
 
-def build_uef(files):
+def load_file_data(files):
+
+    # Return the definitions of the file names and of the OSFILE control
+    # blocks used by the loader to load each file to its address, which are
+    # included in separate places in the loader.
+    names = blocks = ""
+    for label, name, address, length in files:
+    
+        end = address + length
+        names += '%s_file_name: .byte "%s", 13\n' % (label, name)
+        blocks += (
+            "\n"
+            "%s_block: .byte <%s_file_name, >%s_file_name\n"
+            "               .byte $%02x, $%02x, 0, 0\n"
+            "               .byte $%02x, $%02x, 0, 0\n"
+            "               .byte $%02x, $%02x, 0, 0\n"
+            "               .byte $%02x, $%02x, 0, 0\n"
+            ) % (label, label, label, address & 0xff, address >> 8,
+                 address & 0xff, address >> 8, length & 0xff, length >> 8,
+                 end & 0xff, end >> 8)
+    
+    return names, blocks
+
+def copy_code(source, destination, length):
+
+    # Return code that copies data from one address to another, copying a
+    # byte of each whole page in each pass of the first loop and the bytes
+    # after the last whole page in the second loop.
+    pages, remainder = divmod(length, 256)
+    code = ""
+    
+    if pages:
+        code += "ldx #0\n" "copy_graphics_pages_loop:\n"
+        for i in range(pages):
+            code += "lda $%04x,x\n" "sta $%04x,x\n" % (source + i * 256, destination + i * 256)
+        code += "inx\n" "bne copy_graphics_pages_loop\n"
+    
+    if remainder:
+        code += (
+            "ldx #0\n"
+            "copy_graphics_bytes_loop:\n"
+            "lda $%04x,x\n"
+            "sta $%04x,x\n"
+            "inx\n"
+            "cpx #$%02x\n"
+            "bne copy_graphics_bytes_loop\n"
+            ) % (source + pages * 256, destination + pages * 256, remainder)
+    
+    return code
+
+def build_uef(files, short_gaps = False):
 
     u = UEFfile.UEFfile(creator = 'build.py '+version)
     u.minor = 6
@@ -110,24 +160,22 @@ def build_uef(files):
     
     u.import_files(0, files)
     
-    # Insert a gap before each file.
-    offset = 0
-    for f in u.contents:
-    
-        # Insert a gap and some padding before the file.
-        gap_padding = [(0x112, "\xdc\x05"), (0x110, "\xdc\x05"), (0x100, "\xdc")]
-        u.chunks = u.chunks[:f["position"] + offset] + \
-                   gap_padding + u.chunks[f["position"] + offset:]
-
-        # Each time we insert a gap, the position of the file changes, so we
-        # need to update its position and last position. This isn't really
-        # necessary because we won't read the contents list again.
-        offset += len(gap_padding)
-        f["position"] += offset
-        f["last position"] += offset
+    # Insert a gap and some padding before each file. The insertions are
+    # made in a single pass over the list of chunks, and the positions of
+    # the files in the contents list are updated.
+    gap_padding = [(0x112, "\xdc\x05"), (0x110, "\xdc\x05"), (0x100, "\xdc")]
+    u.insert_chunks(map(lambda f: (f["position"], gap_padding), u.contents))
 
     u.chunks += [(0x110, "\xdc\x05")]
 
+    if short_gaps:
+        # Shorten the gaps and tones to the minimum accepted by the OS and
+        # report the loading time saved.
+        before = u.tape_time()
+        u.shorten_gaps()
+        after = u.tape_time()
+        print "Tape loading time: %.1f s (%.1f s saved)" % (after, before - after)
+
     return u
 
 
@@ -141,9 +189,21 @@ if __name__ == "__main__":
     if quiet:
         args.remove("-q")
 
+    # Short gaps mode shortens the gaps and carrier tones between files and
+    # blocks to reduce the loading time.
+    short_gaps = "-s" in args
+    if short_gaps:
+        args.remove("-s")
+
+    # Fast mode stores the character and tile sprites in a single file that
+    # the loader copies into place, saving the gaps and headers of one file.
+    fast = "-f" in args
+    if fast:
+        args.remove("-f")
+
     if len(args) != 2:
     
-        sys.stderr.write("Usage: %s <new UEF file>\n" % sys.argv[0])
+        sys.stderr.write("Usage: %s [-q] [-s] [-f] <new UEF file>\n" % sys.argv[0])
         sys.exit(1)
     
     out_uef_file = args[1]
@@ -271,12 +331,55 @@ if __name__ == "__main__":
             "jsr $fff4\n"
             )
     
+    sprites = makesprites.read_sprites(makesprites.tiles)
+    chars = makesprites.read_sprites(makesprites.chars)
+    
+    if fast:
+        # Load the tiles and characters as a single file, with the tiles
+        # first, so that the characters are loaded directly to their
+        # address. The tiles are loaded into the space used later by CODE
+        # and copied into place before CODE is loaded. The loader itself
+        # occupies the space between the characters and tiles.
+        graphics_start = 0x3f00 - len(sprites)
+        graphics_names, graphics_blocks = load_file_data([
+            ("graphics", "GRAPHICS", graphics_start, len(sprites) + len(chars))])
+        load_graphics = (
+            "lda #255\n"
+            "ldx #<graphics_block\n"
+            "ldy #>graphics_block\n"
+            "jsr $ffdd\n"
+            ) + copy_code(graphics_start, 0x5400, len(sprites))
+    else:
+        graphics_names, graphics_blocks = load_file_data([
+            ("sprites", "SPRITES", 0x5400, len(sprites)),
+            ("chars", "CHARS", 0x3f00, len(chars))])
+        load_graphics = (
+            "lda #255\n"
+            "ldx #<sprites_block\n"
+            "ldy #>sprites_block\n"
+            "jsr $ffdd\n"
+            "lda #255\n"
+            "ldx #<chars_block\n"
+            "ldy #>chars_block\n"
+            "jsr $ffdd\n"
+            )
+    
     open("preload.oph", "w").write(preload)
     open("postload.oph", "w").write(postload)
+    open("loadgraphics.oph", "w").write(load_graphics)
+    open("graphicsnames.oph", "w").write(graphics_names)
+    open("graphicsblocks.oph", "w").write(graphics_blocks)
     
     system("ophis loader.oph -o JUNGLE")
     code = open("JUNGLE").read()
     code_start = 0x5180
+    
+    # The end of the loader runs after the tiles have been loaded or copied
+    # to 5400, so it must not extend beyond that address.
+    if code_start + len(code) > 0x5400:
+        sys.stderr.write("The loader is too large (it ends at %x).\n" % (code_start + len(code)))
+        sys.exit(1)
+    
     files.append(("JUNGLE", code_start, code_start, code))
     
     data = makesprites.read_sprites([makesprites.title])
@@ -286,39 +389,39 @@ if __name__ == "__main__":
     data += combined
     files.append(("TITLE", 0x5AA0, 0x5AA0, data))
 
-    data = makesprites.read_sprites(makesprites.tiles)
-    files.append(("SPRITES", 0x5400, 0x5400, data))
-    
-    data = makesprites.read_sprites(makesprites.chars)
-    files.append(("CHARS", 0x3f00, 0x3f00, data))
+    if fast:
+        files.append(("GRAPHICS", graphics_start, graphics_start, sprites + chars))
+    else:
+        files.append(("SPRITES", 0x5400, 0x5400, sprites))
+        files.append(("CHARS", 0x3f00, 0x3f00, chars))
 
     system("ophis tapecode.oph -o CODE")
     code = open("CODE").read()
     code_start = 0x1e00
     files.append(("CODE", code_start, code_start, code))
     
-    u = build_uef(files)
+    u = build_uef(files, short_gaps)
     
-    # Write the new UEF file.
-    try:
-        u.write(out_uef_file, write_emulator_info = False)
-    except UEFfile.UEFfile_error:
-        sys.stderr.write("Couldn't write the new executable to %s.\n" % out_uef_file)
-        sys.exit(1)
-    
-    # Write a UEF file for transfer to ADFS.
+    # Create a UEF file for transfer to ADFS.
 
     # Replace the loader and insert a boot file.
     files.pop(0)
     files.insert(0, ("RETRO", 0x1d00, 0x8023, open("resources/loader_U3A", "rb").read()))
     files.insert(0, ("!BOOT", 0x0, 0x0, 'CHAIN "RETRO"\r'))
     
-    u = build_uef(files)
+    adfs_u = build_uef(files, short_gaps)
     out_uef_adf_file = out_uef_file.replace(".uef", "-for-ADFS.uef")
+    
+    # Write the new UEF files at the same time.
+    # Update the files from previous builds, rewriting them from the first
+    # change. Small blocks are compressed independently so that the index
+    # has enough restart points to leave the earlier files in place.
     try:
-        u.write(out_uef_adf_file, write_emulator_info = False)
-    except UEFfile.UEFfile_error:
-        sys.stderr.write("Couldn't write the new executable to %s.\n" % out_uef_adf_file)
+        UEFfile.write_files([(u, out_uef_file), (adfs_u, out_uef_adf_file)],
+                            update = True, write_emulator_info = False,
+                            index = True, block_size = 16384)
+    except UEFfile.UEFfile_error, exception:
+        sys.stderr.write("Couldn't write the new executables: %s\n" % exception)
         sys.exit(1)
     
     print
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2011 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, multiprocessing, os, sys, time
+import UEFfile
+from uefverify import find_uef_files
+
+def process_file(path):
+
+    """Reads the UEF file with the given path and returns a dictionary
+    containing its catalogue, metadata, the results of checking the CRCs
+    of its blocks and the time spent in each phase of the work."""
+    
+    start = time.time()
+    record = {"path": path}
+    profile = UEFfile.Profile()
+    
+    try:
+        record["size"] = os.path.getsize(path)
+        u = UEFfile.UEFfile(path, lazy = True, profile = profile)
+    except (EnvironmentError, EOFError, UEFfile.UEFfile_error), exception:
+        record["error"] = str(exception)
+        record["time"] = time.time() - start
+        return record
+    
+    try:
+        record["version"] = "%i.%i" % (u.major, u.minor)
+        record["creator"] = u.creator.decode("latin-1")
+        record["target machine"] = u.target_machine
+        record["keyboard layout"] = u.keyboard_layout
+        record["emulator"] = u.emulator.decode("latin-1")
+        record["features"] = filter(None, u.features.split("\n"))
+        record["chunks"] = len(u.chunks)
+        
+        files = []
+        for details in u.contents:
+            files.append({"name": details["name"].decode("latin-1"),
+                          "load": details["load"], "exec": details["exec"],
+                          "length": len(details["data"]), "blocks": details["blocks"],
+                          "position": details["position"],
+                          "last position": details["last position"]})
+        
+        record["files"] = files
+        
+        bad_blocks = []
+        for file_number, name, block_number, position, header_ok, data_ok in u.verify():
+            bad_blocks.append({"file": file_number, "name": name.decode("latin-1"),
+                               "block": block_number, "position": position,
+                               "header CRC": header_ok, "data CRC": data_ok})
+        
+        record["bad blocks"] = bad_blocks
+        record["CRC ok"] = not bad_blocks
+    
+    except Exception, exception:
+        # Report damaged files instead of letting them stop the batch.
+        record["error"] = "Failed to read the contents: %s" % exception
+    
+    u.close()
+    record["time"] = time.time() - start
+    record["phases"] = profile.phases
+    return record
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    options = {"-j": None, "-o": None}
+    
+    for option in options.keys():
+        if option in args:
+            i = args.index(option)
+            if i + 1 < len(args):
+                options[option] = args[i + 1]
+                del args[i:i + 2]
+            else:
+                args = []
+    
+    try:
+        if options["-j"] != None:
+            options["-j"] = int(options["-j"])
+    except ValueError:
+        args = []
+    
+    if not args:
+    
+        sys.stderr.write("Usage: %s [-j <processes>] [-o <JSON Lines file>] "
+                         "<UEF file, directory or pattern>...\n" % sys.argv[0])
+        sys.exit(1)
+    
+    uef_files = find_uef_files(args)
+    
+    if options["-o"] != None:
+        output = open(options["-o"], "w")
+    else:
+        output = sys.stdout
+    
+    pool = multiprocessing.Pool(options["-j"])
+    start = time.time()
+    
+    processed = errors = bad = total_size = 0
+    
+    # Write each record as soon as it is available so that the output can
+    # be read while the job is running.
+    for record in pool.imap_unordered(process_file, uef_files):
+    
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+        
+        processed += 1
+        total_size += record.get("size", 0)
+        if "error" in record:
+            errors += 1
+        elif not record["CRC ok"]:
+            bad += 1
+        
+        elapsed = time.time() - start
+        sys.stderr.write("[%i/%i] %s (%.3f s, %.1f files/s)\n" % (
+            processed, len(uef_files), record["path"], record["time"],
+            processed / max(elapsed, 1e-9)))
+    
+    pool.close()
+    pool.join()
+    
+    if output != sys.stdout:
+        output.close()
+    
+    elapsed = time.time() - start
+    sys.stderr.write("Processed %i files (%i bytes) in %.3f s: %i unreadable, "
+                     "%i with bad CRCs, %.1f files/s, %.2f MB/s\n" % (
+                     processed, total_size, elapsed, errors, bad,
+                     processed / max(elapsed, 1e-9),
+                     total_size / max(elapsed, 1e-9) / 1048576))
+    
+    # Exit
+    sys.exit()
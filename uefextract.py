@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2011 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import UEFfile
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+    
+        sys.stderr.write("Usage: %s <UEF file> <directory>\n" % sys.argv[0])
+        sys.exit(1)
+    
+    uef_file, directory = sys.argv[1:]
+    
+    try:
+        # Read the chunks lazily so that only one block is held in memory
+        # while each file is written.
+        u = UEFfile.UEFfile(uef_file, lazy = True)
+        try:
+            paths = u.extract_files(directory)
+        finally:
+            u.close()
+    except UEFfile.UEFfile_error, exception:
+        sys.stderr.write("%s\n" % exception)
+        sys.exit(1)
+    
+    for path in paths:
+        print "Written", path
+    
+    sys.exit()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2011 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import gzip, hashlib, json, os, struct, sys, zlib
+import UEFfile
+from uefverify import find_uef_files
+
+# Index entries: object digest, offset in the pack file, stored length and
+# whether the stored data is compressed
+entry_struct = struct.Struct('<20sQIB')
+
+# Chunks in a segment: chunk ID and whether the data is stored in the
+# segment or referred to by its digest
+ref_struct = struct.Struct('<HB')
+length_struct = struct.Struct('<I')
+
+# Chunks with data no longer than this are stored in their segments
+inline_limit = 32
+
+
+class BlockStore:
+    """store = BlockStore(path)
+
+    Open the store in the directory with the specified path, creating it if
+    necessary. Objects, such as the payloads of tape blocks, are added to
+    the store with the put method, which returns the SHA-1 digest of the
+    data. Each distinct object is only stored once, so the store occupies
+    roughly the space of the unique objects put into it.
+
+    Objects are appended to a pack file and their positions are recorded in
+    an index file, which is read when the store is opened.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.objects = {}
+
+        index_path = os.path.join(path, 'index')
+
+        if os.path.exists(index_path):
+
+            data = open(index_path, 'rb').read()
+            size = entry_struct.size
+
+            for offset in range(0, len(data) - size + 1, size):
+                digest, position, length, compressed = \
+                    entry_struct.unpack_from(data, offset)
+                self.objects[digest] = (position, length, compressed)
+
+        self.pack = open(os.path.join(path, 'pack'), 'a+b')
+        self.index = open(index_path, 'ab')
+
+        self.pack.seek(0, 2)
+        self.size = self.pack.tell()
+
+
+    def put(self, data):
+        """Add the data given to the store if it is not already stored,
+        returning its digest."""
+
+        data = str(data)
+        digest = hashlib.sha1(data).digest()
+
+        if digest in self.objects:
+            return digest
+
+        # Only keep compressed data if it is smaller than the original
+        compressed = zlib.compress(data, 9)
+        if len(compressed) < len(data):
+            data = compressed
+            flag = 1
+        else:
+            flag = 0
+
+        self.pack.seek(0, 2)
+        self.pack.write(data)
+        self.index.write(entry_struct.pack(digest, self.size, len(data), flag))
+
+        self.objects[digest] = (self.size, len(data), flag)
+        self.size = self.size + len(data)
+
+        return digest
+
+
+    def get(self, digest):
+        """Return the data stored with the digest given."""
+
+        try:
+            position, length, compressed = self.objects[digest]
+        except KeyError:
+            raise UEFfile.UEFfile_error, 'Object %s is not in the store.' % \
+                                         digest.encode('hex')
+
+        self.pack.seek(position)
+        data = self.pack.read(length)
+
+        if compressed:
+            data = zlib.decompress(data)
+
+        return data
+
+
+    def put_segment(self, chunks):
+        """Store a list of chunks as a segment, returning the segment's
+        digest. The data of each large chunk is stored separately so that
+        it can be shared with other segments."""
+
+        pieces = []
+
+        for chunk_id, data in chunks:
+
+            if len(data) <= inline_limit:
+                pieces.append(ref_struct.pack(chunk_id, 0))
+                pieces.append(length_struct.pack(len(data)))
+                pieces.append(str(data))
+            else:
+                pieces.append(ref_struct.pack(chunk_id, 1))
+                pieces.append(self.put(data))
+
+        return self.put(''.join(pieces))
+
+
+    def get_segment(self, digest):
+        """Return the list of chunks in the segment with the digest given."""
+
+        data = self.get(digest)
+        chunks = []
+        offset = 0
+
+        while offset < len(data):
+
+            chunk_id, stored = ref_struct.unpack_from(data, offset)
+            offset = offset + ref_struct.size
+
+            if stored:
+                chunks.append((chunk_id, self.get(data[offset:offset + 20])))
+                offset = offset + 20
+            else:
+                length = length_struct.unpack_from(data, offset)[0]
+                offset = offset + length_struct.size
+                chunks.append((chunk_id, data[offset:offset + length]))
+                offset = offset + length
+
+        return chunks
+
+
+    def flush(self):
+
+        self.pack.flush()
+        self.index.flush()
+
+
+    def close(self):
+
+        self.pack.close()
+        self.index.close()
+
+
+def read_chunks(filename):
+    """minor, major, compressed, chunks = read_chunks(filename)
+
+    Read all the chunks in the UEF file with the specified filename,
+    including the ones describing the file, returning the format version,
+    whether the file is compressed and a ChunkTable for the chunks.
+    """
+
+    try:
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+    except IOError:
+        raise UEFfile.UEFfile_error, 'The input file, '+filename+' could not be found.'
+
+    compressed = data[:10] != 'UEF File!\000'
+
+    if compressed:
+        try:
+            data = gzip.open(filename, 'rb').read()
+        except (IOError, EOFError, zlib.error):
+            raise UEFfile.UEFfile_error, 'The input file, '+filename+' could not be read.'
+
+        if data[:10] != 'UEF File!\000':
+            raise UEFfile.UEFfile_error, 'The input file, '+filename+' is not a UEF file.'
+
+    chunks = UEFfile.ChunkTable(data, mapped = True)
+    chunks.read_headers(12)
+
+    return ord(data[10]), ord(data[11]), compressed, chunks
+
+
+def segments(chunks):
+    """Divide a sequence of chunks into lists of chunks, ending each list
+    after the last block of a file or a chunk that is not part of a file.
+    The chunks for each file are then stored in the same segment in every
+    UEF file that contains it."""
+
+    u = UEFfile.UEFfile()
+    segment = []
+
+    for chunk in chunks:
+
+        segment.append(chunk)
+
+        if chunk[0] < 0x100:
+            last = True
+        elif u.is_block(chunk):
+            try:
+                last = u.read_block(chunk)[5]
+            except IndexError:
+                last = False
+        else:
+            last = False
+
+        if last:
+            yield segment
+            segment = []
+
+    if segment:
+        yield segment
+
+
+def import_uef(store, filename):
+    """manifest = import_uef(store, filename)
+
+    Store the chunks of the UEF file with the specified filename in the
+    BlockStore given, returning a manifest describing the file.
+    """
+
+    minor, major, compressed, chunks = read_chunks(filename)
+
+    digests = []
+    for segment in segments(chunks):
+        digests.append(store.put_segment(segment).encode('hex'))
+
+    return {'version': 1, 'minor': minor, 'major': major,
+            'compressed': compressed, 'segments': digests}
+
+
+def export_uef(store, manifest, filename):
+    """export_uef(store, manifest, filename)
+
+    Write the UEF file described by the manifest to a file with the
+    specified filename, reading its chunks from the BlockStore given.
+    """
+
+    if manifest.get('version') != 1:
+        raise UEFfile.UEFfile_error, 'Unsupported manifest version.'
+
+    if manifest['compressed']:
+        compresslevel = 9
+    else:
+        compresslevel = None
+
+    writer = UEFfile.UEFWriter(filename, manifest['minor'], manifest['major'],
+                               compresslevel)
+    try:
+        for digest in manifest['segments']:
+            writer.write_chunks(store.get_segment(digest.decode('hex')))
+    finally:
+        writer.close()
+
+
+def manifest_path(filename):
+
+    return filename + UEFfile.suffix + 'manifest'
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+
+    if len(args) < 3 or args[0] not in ("import", "export") or \
+       (args[0] == "export" and len(args) != 4):
+
+        sys.stderr.write("Usage: %s import <store directory> <UEF file, directory or pattern>...\n"
+                         "       %s export <store directory> <manifest file> <new UEF file>\n" % (
+                         sys.argv[0], sys.argv[0]))
+        sys.exit(1)
+
+    command, store_path = args[:2]
+    store = BlockStore(store_path)
+
+    try:
+        if command == "import":
+
+            for path in find_uef_files(args[2:]):
+
+                try:
+                    manifest = import_uef(store, path)
+                except UEFfile.UEFfile_error, exception:
+                    sys.stderr.write("%s\n" % exception)
+                    continue
+
+                f = open(manifest_path(path), "w")
+                json.dump(manifest, f)
+                f.close()
+
+                print "Stored", path
+        else:
+            manifest_file, out_uef_file = args[2:]
+
+            try:
+                manifest = json.load(open(manifest_file))
+                export_uef(store, manifest, out_uef_file)
+            except (IOError, ValueError, UEFfile.UEFfile_error), exception:
+                sys.stderr.write("Couldn't rebuild %s: %s\n" % (out_uef_file, exception))
+                sys.exit(1)
+
+            print "Written", out_uef_file
+    finally:
+        store.close()
+
+    # Exit
+    sys.exit()
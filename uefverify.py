@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2011 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import glob, multiprocessing, os, sys, zlib
+import UEFfile
+
+def find_uef_files(paths):
+
+    """Returns a list of the UEF files given by a list of paths, which may
+    include directories to be searched and glob patterns."""
+    
+    uef_files = []
+    
+    for path in paths:
+    
+        if glob.has_magic(path):
+            uef_files += find_uef_files(sorted(glob.glob(path)))
+        
+        elif os.path.isdir(path):
+        
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for name in sorted(file_names):
+                    if name.lower().endswith(".uef"):
+                        uef_files.append(os.path.join(dir_path, name))
+        else:
+            uef_files.append(path)
+    
+    return uef_files
+
+def verify_file(path, pool = None):
+
+    """path, error, bad_blocks = verify_file(path, pool)
+    
+    Checks the CRCs of all the blocks in the UEF file with the given path,
+    returning the path, an error message if the file could not be read, and
+    a list of bad blocks as returned by UEFfile.verify.
+    """
+    
+    # Damaged files, such as truncated compressed files, may fail to be read
+    # when they are opened or while their blocks are checked, and are
+    # reported as unreadable instead of stopping the check of other files.
+    errors = (EnvironmentError, EOFError, zlib.error, UEFfile.UEFfile_error)
+    
+    try:
+        u = UEFfile.UEFfile(path, lazy = True)
+    except errors, exception:
+        return path, "unreadable: %s" % exception, []
+    
+    try:
+        bad_blocks = u.verify(pool)
+    except errors, exception:
+        return path, "unreadable: %s" % exception, []
+    finally:
+        u.close()
+    
+    return path, None, bad_blocks
+
+def report(path, error, bad_blocks):
+
+    if error:
+        print "%s: %s" % (path, error)
+    
+    for file_number, name, block_number, position, header_ok, data_ok in bad_blocks:
+    
+        problems = []
+        if not header_ok:
+            problems.append("bad header CRC")
+        if not data_ok:
+            problems.append("bad data CRC")
+        
+        if block_number == None:
+            block = "block ?"
+        else:
+            block = "block %i" % block_number
+        
+        print "%s: file %i (%s) %s at chunk %i: %s" % (
+            path, file_number, name, block, position, ", ".join(problems))
+    
+    return not error and not bad_blocks
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    
+    processes = None
+    if "-j" in args:
+        i = args.index("-j")
+        try:
+            processes = int(args[i + 1])
+        except (IndexError, ValueError):
+            args = []
+        else:
+            del args[i:i + 2]
+    
+    if not args:
+    
+        sys.stderr.write("Usage: %s [-j <processes>] <UEF file or directory>...\n" % sys.argv[0])
+        sys.exit(1)
+    
+    uef_files = find_uef_files(args)
+    pool = multiprocessing.Pool(processes)
+    
+    if len(uef_files) == 1:
+        # Spread the blocks of a single file across the processes.
+        results = [verify_file(uef_files[0], pool)]
+    else:
+        # Check each file in its own process.
+        results = pool.imap(verify_file, uef_files)
+    
+    failed = 0
+    for path, error, bad_blocks in results:
+        if not report(path, error, bad_blocks):
+            failed += 1
+    
+    pool.close()
+    pool.join()
+    
+    if failed:
+        sys.stderr.write("%i of %i files failed verification.\n" % (failed, len(uef_files)))
+        sys.exit(1)
+    
+    # Exit
+    sys.exit()
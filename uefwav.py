@@ -0,0 +1,686 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2011 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math, multiprocessing, os, struct, sys, tempfile, wave
+import numpy
+import UEFfile
+
+def timing_value(chunk):
+    """Return the value held in a timing chunk."""
+
+    return UEFfile.timing_structs[chunk[0]].unpack_from(chunk[1])[0]
+
+
+class WaveRenderer:
+    """renderer = WaveRenderer(filename, sample_rate, buffer_size, amplitude)
+
+    Create a mono 16-bit WAV file with the specified filename and sample
+    rate, to which the tape signals described by UEF chunks can be written.
+    Samples are written to the file in buffers of buffer_size samples so
+    that the memory used does not depend on the length of the tape.
+
+    Each data bit is one cycle of the base frequency for a zero or two
+    cycles of twice the base frequency for a one. The samples for each bit
+    are copied from precomputed waveforms instead of being calculated for
+    each bit.
+    """
+
+    def __init__(self, filename, sample_rate = 44100, buffer_size = 65536,
+                 amplitude = 0.5):
+
+        try:
+            self.file = wave.open(filename, 'wb')
+        except IOError:
+            raise UEFfile.UEFfile_error, "Couldn't open %s for writing." % filename
+
+        self.file.setnchannels(1)
+        self.file.setsampwidth(2)
+        self.file.setframerate(sample_rate)
+
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.scale = amplitude * 32767
+
+        self.pieces = []
+        self.buffered = 0
+
+        # The exact position in samples of the end of the signal written so
+        # far, used to avoid accumulating rounding errors
+        self.position = 0.0
+
+        self.base = 1200.0
+        self.bit_cycles = 1
+
+        # Waveforms for each number of samples per bit
+        self.tables = {}
+
+
+    def write_samples(self, samples):
+        """Add an array of samples in the range -1.0 to 1.0 to the buffer,
+        writing complete buffers to the file."""
+
+        self.pieces.append(samples)
+        self.buffered = self.buffered + len(samples)
+
+        if self.buffered < self.buffer_size:
+            return
+
+        samples = numpy.concatenate(self.pieces)
+        end = len(samples) - (len(samples) % self.buffer_size)
+
+        for i in range(0, end, self.buffer_size):
+            self.write_frames(samples[i:i + self.buffer_size])
+
+        self.pieces = [samples[end:]]
+        self.buffered = len(samples) - end
+
+
+    def write_frames(self, samples):
+
+        frames = numpy.round(samples * self.scale).astype('<i2')
+        self.file.writeframes(frames.tostring())
+
+
+    def advance(self, duration):
+        """Return the number of samples needed to continue the signal for
+        the duration given in seconds."""
+
+        start = int(round(self.position))
+        self.position = self.position + duration * self.sample_rate
+        return int(round(self.position)) - start
+
+
+    def waveforms(self, samples_per_bit):
+        """Return the shortest number of samples used for a bit, the
+        longest, and a table of waveforms for the bits, indexed by the bit
+        value and whether the bit uses the longer number of samples."""
+
+        key = (samples_per_bit, self.bit_cycles)
+
+        if key not in self.tables:
+
+            shortest = int(math.floor(samples_per_bit))
+            longest = shortest + 1
+            table = numpy.zeros((4, longest))
+
+            for bit in range(2):
+                for length in (shortest, longest):
+                    # Sample the middle of each interval in the bit
+                    t = (numpy.arange(length) + 0.5) / length
+                    cycles = self.bit_cycles * (bit + 1)
+                    table[bit * 2 + length - shortest, :length] = \
+                        numpy.sin(2 * numpy.pi * cycles * t)
+
+            self.tables[key] = (shortest, longest, table.ravel())
+
+        return self.tables[key]
+
+
+    def bits(self, bits):
+        """Write the signal for an array of bits."""
+
+        samples_per_bit = self.sample_rate * self.bit_cycles / self.base
+        shortest, longest, table = self.waveforms(samples_per_bit)
+
+        # Write the bits in pieces no larger than the buffer
+        step = max(1, self.buffer_size / longest)
+
+        for i in range(0, len(bits), step):
+
+            piece = bits[i:i + step]
+
+            # Find the boundaries of the bits in the output, and the
+            # waveform in the table to use for each bit
+            edges = numpy.round(self.position +
+                                numpy.arange(len(piece) + 1) * samples_per_bit)
+            edges = edges.astype(numpy.int64)
+            self.position = self.position + len(piece) * samples_per_bit
+
+            lengths = numpy.diff(edges)
+            rows = piece.astype(numpy.int64) * 2 + lengths - shortest
+
+            # Map each output sample to a sample in the table
+            offsets = numpy.repeat(rows * longest - edges[:-1], lengths)
+            self.write_samples(table[offsets + numpy.arange(edges[0], edges[-1])])
+
+
+    def tone(self, cycles):
+        """Write a carrier tone with the number of cycles at twice the base
+        frequency given."""
+
+        bit_cycles = self.bit_cycles
+        self.bit_cycles = 1
+
+        try:
+            # Each one bit contains two cycles of the tone
+            self.bits(numpy.ones(cycles / 2, numpy.uint8))
+        finally:
+            self.bit_cycles = bit_cycles
+
+        if cycles % 2 != 0:
+            length = self.advance(0.5 / self.base)
+            t = (numpy.arange(length) + 0.5) / length
+            self.write_samples(numpy.sin(2 * numpy.pi * t))
+
+
+    def silence(self, duration):
+        """Write silence for the duration given in seconds."""
+
+        length = self.advance(duration)
+
+        for i in range(0, length, self.buffer_size):
+            self.write_samples(numpy.zeros(min(self.buffer_size, length - i)))
+
+
+    def bytes(self, data, bits = 8, parity = 'N', stop_bits = 1):
+        """Write a string of bytes, each with a start bit, the number of
+        data bits given, least significant first, an optional parity bit
+        and the number of stop bits specified."""
+
+        values = numpy.frombuffer(str(data), numpy.uint8)
+        data_bits = (values[:, numpy.newaxis] >> numpy.arange(bits)) & 1
+
+        columns = [numpy.zeros((len(values), 1), numpy.uint8), data_bits]
+
+        if parity != 'N':
+            odd = data_bits.sum(axis = 1) % 2
+            if parity == 'O':
+                odd = 1 - odd
+            columns.append(odd[:, numpy.newaxis].astype(numpy.uint8))
+
+        columns.append(numpy.ones((len(values), stop_bits), numpy.uint8))
+
+        self.bits(numpy.hstack(columns).ravel())
+
+
+    def write_chunk(self, chunk, ignore_byte = True):
+        """Write the signal described by a chunk. If ignore_byte is True
+        then the first byte of a defined tape format chunk (0x102) gives
+        the number of bits to ignore at the end of the data, as in UEF
+        files of version 0.9 and later."""
+
+        chunk_id, data = chunk
+
+        if chunk_id == 0x100:
+            self.bytes(data)
+
+        elif chunk_id == 0x102:
+            if ignore_byte:
+                ignore = ord(data[0])
+                data = data[1:]
+            else:
+                ignore = 0
+
+            values = numpy.frombuffer(str(data), numpy.uint8)
+            bits = ((values[:, numpy.newaxis] >> numpy.arange(8)) & 1).ravel()
+            self.bits(bits[:len(bits) - ignore])
+
+        elif chunk_id == 0x104:
+            stop_bits = struct.unpack('<b', data[2])[0]
+            self.bytes(data[3:], ord(data[0]), data[1], abs(stop_bits))
+
+        elif chunk_id == 0x110:
+            self.tone(timing_value(chunk))
+
+        elif chunk_id == 0x111:
+            before, after = struct.unpack('<HH', data[:4])
+            self.tone(before)
+            self.bytes('\xaa')
+            self.tone(after)
+
+        elif chunk_id == 0x112:
+            self.silence(timing_value(chunk) / (2 * self.base))
+
+        elif chunk_id == 0x113:
+            self.base = float(timing_value(chunk))
+
+        elif chunk_id == 0x116:
+            self.silence(timing_value(chunk))
+
+        elif chunk_id == 0x117:
+            self.bit_cycles = 1200 / timing_value(chunk)
+
+        # Other chunks do not describe signals.
+
+
+    def write_uef(self, uef):
+        """Write the signals described by the chunks of a UEFfile instance."""
+
+        ignore_byte = not (uef.major == 0 and uef.minor < 9)
+
+        for chunk in uef.chunks:
+            self.write_chunk(chunk, ignore_byte)
+
+
+    def close(self):
+        """Write any buffered samples and close the file."""
+
+        try:
+            if self.pieces:
+                self.write_frames(numpy.concatenate(self.pieces))
+                self.pieces = []
+        finally:
+            self.file.close()
+
+
+def render(uef, filename, sample_rate = 44100, buffer_size = 65536):
+    """render(uef, filename, sample_rate, buffer_size)
+
+    Write the tape signals described by a UEFfile instance to a WAV file
+    with the specified filename and sample rate.
+    """
+
+    renderer = WaveRenderer(filename, sample_rate, buffer_size)
+    try:
+        renderer.write_uef(uef)
+    finally:
+        renderer.close()
+
+
+# Classes of the cycles found in a recording
+SHORT, LONG, GAP = 0, 1, 2
+
+class CycleReader:
+    """reader = CycleReader(filename, base, threshold, block_size)
+
+    Open the WAV file with the specified filename and find the cycles in
+    the recording, using the base frequency given to classify each cycle as
+    a short cycle of twice the base frequency, a long cycle of the base
+    frequency or a gap. Samples nearer to zero than a level found from the
+    loudest samples in each block, or than the threshold given as a fraction
+    of full scale if that is higher, do not change the sign of the signal.
+
+    The recording is read in blocks of block_size samples so that only the
+    cycles, not the samples, are held in memory. The classes and lengths
+    attributes are arrays containing the class and length in samples of
+    each cycle.
+    """
+
+    def __init__(self, filename, base = 1200.0, threshold = 0.02,
+                 block_size = 1048576):
+
+        try:
+            f = wave.open(filename, 'rb')
+        except (IOError, EOFError, wave.Error):
+            raise UEFfile.UEFfile_error, 'The input file, '+filename+' could not be read.'
+
+        self.sample_rate = f.getframerate()
+        self.base = float(base)
+
+        channels = f.getnchannels()
+        width = f.getsampwidth()
+
+        if width == 1:
+            dtype, offset, full_scale = numpy.uint8, 128, 128
+        elif width == 2:
+            dtype, offset, full_scale = numpy.dtype('<i2'), 0, 32768
+        else:
+            f.close()
+            raise UEFfile.UEFfile_error, 'Only 8-bit and 16-bit WAV files are supported.'
+
+        # The positions of rising edges, where the signal changes from
+        # negative to positive, and falling edges
+        edges = []
+        falling = []
+        state = 0
+        position = 0
+
+        try:
+            while 1:
+
+                frames = f.readframes(block_size)
+                if not frames:
+                    break
+
+                # Use the first channel
+                samples = numpy.frombuffer(frames, dtype)[::channels]
+                samples = samples.astype(numpy.int32) - offset
+
+                level = max(threshold * full_scale,
+                            0.3 * numpy.percentile(numpy.abs(samples), 99))
+
+                # Give each sample the sign of the last sample that was
+                # further from zero than the threshold
+                signs = numpy.where(samples > level, 1,
+                                    numpy.where(samples < -level, -1, 0))
+                signs = numpy.concatenate(([state], signs))
+
+                indices = numpy.where(signs != 0, numpy.arange(len(signs)), 0)
+                signs = signs[numpy.maximum.accumulate(indices)]
+
+                rising = numpy.nonzero((signs[:-1] < 0) & (signs[1:] > 0))[0]
+                edges.append(rising + position)
+                rising = numpy.nonzero((signs[:-1] > 0) & (signs[1:] < 0))[0]
+                falling.append(rising + position)
+
+                state = signs[-1]
+                position = position + len(samples)
+        finally:
+            f.close()
+
+        # The last cycle ends at the end of the recording
+        edges.append(numpy.array([position]))
+        edges = numpy.concatenate(edges)
+        falling.append(numpy.array([position]))
+        falling = numpy.concatenate(falling)
+
+        starts = edges[:-1]
+        lengths = numpy.diff(edges)
+
+        # A cycle followed by silence only ends at the rising edge after
+        # the silence, so estimate the length of each such cycle from its
+        # first half and divide it from the gap
+        long_length = self.sample_rate / self.base
+        gaps = numpy.nonzero(lengths >= 1.5 * long_length)[0]
+        halves = falling[numpy.searchsorted(falling, starts[gaps])] - starts[gaps]
+        cycles = numpy.minimum(halves * 2, lengths[gaps])
+
+        lengths[gaps] = cycles
+        lengths = numpy.insert(lengths, gaps + 1, edges[gaps + 1] - starts[gaps] - cycles)
+
+        # Include any silence before the first cycle
+        if len(edges) > 1 and edges[0] >= 1.5 * long_length:
+            lengths = numpy.concatenate(([edges[0]], lengths))
+
+        # Classify the cycles by comparing their lengths with the length
+        # of a cycle of the base frequency
+        self.lengths = lengths
+        self.classes = numpy.where(lengths < 0.75 * long_length, SHORT,
+                       numpy.where(lengths < 1.5 * long_length, LONG, GAP))
+        self.classes = self.classes.astype(numpy.uint8)
+
+
+    def segments(self, min_tone = 64):
+        """Return a list of (start, end) tuples giving the ranges of cycles
+        in independent segments of the recording. The recording is divided
+        in the middle of each carrier tone of at least min_tone cycles, an
+        even number of cycles after the start of the tone."""
+
+        short = numpy.concatenate(([0], self.classes == SHORT, [0])).astype(numpy.int8)
+        changes = numpy.diff(short)
+        run_starts = numpy.nonzero(changes == 1)[0]
+        run_ends = numpy.nonzero(changes == -1)[0]
+
+        tones = (run_ends - run_starts) >= min_tone
+        splits = run_starts[tones] + ((run_ends[tones] - run_starts[tones]) / 4) * 2
+
+        bounds = [0] + list(splits) + [len(self.classes)]
+
+        segments = []
+        for i in range(len(bounds) - 1):
+            if bounds[i] < bounds[i + 1]:
+                segments.append((int(bounds[i]), int(bounds[i + 1])))
+
+        return segments
+
+
+def decode_segment(args):
+    """chunks = decode_segment((classes, lengths, sample_rate, base))
+
+    Decode a segment of a recording, given as arrays of the classes and
+    lengths of its cycles, returning a list of chunks describing the carrier
+    tones (0x110), data (0x100) and gaps (0x112) in the segment. This is
+    used by demodulate to decode segments in other processes.
+    """
+
+    classes, lengths, sample_rate, base = args
+
+    # Divide the cycles into runs of the same class
+    changes = numpy.nonzero(numpy.diff(classes))[0] + 1
+    run_starts = numpy.concatenate(([0], changes))
+    run_counts = numpy.diff(numpy.concatenate((run_starts, [len(classes)])))
+    run_classes = classes[run_starts]
+
+    # Convert the runs to bits, with a one for each pair of short cycles, a
+    # zero for each long cycle and a marker for each gap
+    values = numpy.choose(run_classes, (1, 0, 2)).astype(numpy.uint8)
+    counts = numpy.where(run_classes == SHORT, run_counts / 2, run_counts)
+    bits = numpy.repeat(values, counts)
+
+    # The length of each gap in samples, in the order the gaps occur
+    gaps = list(lengths[classes == GAP])
+    gaps.reverse()
+
+    # The value of the byte whose data bits follow each position and
+    # whether a complete frame starts there
+    padded = numpy.concatenate((bits, numpy.full(10, 2, numpy.uint8)))
+    window = numpy.zeros(len(bits), numpy.int32)
+    valid = (padded[:len(bits)] == 0) & (padded[9:len(bits) + 9] == 1)
+
+    for k in range(8):
+        following = padded[k + 1:len(bits) + k + 1]
+        window = window | (following.astype(numpy.int32) << k)
+        valid = valid & (following < 2)
+
+    # The position of the next bit after each position that is not a one
+    not_one = numpy.nonzero(bits != 1)[0]
+    next_index = numpy.searchsorted(not_one, numpy.arange(len(bits)))
+    next_other = numpy.concatenate((not_one, [len(bits)]))[next_index]
+
+    chunks = []
+    data = []
+    ones = 0
+    i = 0
+
+    while i < len(bits):
+
+        if valid[i]:
+
+            if ones:
+                chunks.append((0x110, struct.pack('<H', min(ones * 2, 0xffff))))
+                ones = 0
+
+            data.append(chr(window[i]))
+            i = i + 10
+            continue
+
+        if data:
+            chunks.append((0x100, ''.join(data)))
+            data = []
+
+        if bits[i] == 1:
+            # Count the carrier tone up to the next bit that is not a one
+            ones = ones + next_other[i] - i
+            i = next_other[i]
+            continue
+
+        if bits[i] == 2:
+
+            if ones:
+                chunks.append((0x110, struct.pack('<H', min(ones * 2, 0xffff))))
+                ones = 0
+
+            # Measure the gap in cycles at twice the base frequency, not
+            # counting the cycle that ends it
+            length = gaps.pop()
+            cycles = int(round((length - sample_rate / (2 * base)) * 2 * base / sample_rate))
+            chunks.append((0x112, struct.pack('<H', max(0, min(cycles, 0xffff)))))
+
+        # Zero bits outside frames are noise
+        i = i + 1
+
+    if data:
+        chunks.append((0x100, ''.join(data)))
+    if ones:
+        chunks.append((0x110, struct.pack('<H', min(ones * 2, 0xffff))))
+
+    return chunks
+
+
+def merge_chunks(chunks):
+    """Return a list of chunks in which consecutive carrier tones (0x110) and
+    gaps (0x112) from neighbouring segments are combined."""
+
+    merged = []
+
+    for chunk_id, data in chunks:
+
+        if merged and chunk_id in (0x110, 0x112) and merged[-1][0] == chunk_id:
+            total = timing_value(merged[-1]) + timing_value((chunk_id, data))
+            merged[-1] = (chunk_id, struct.pack('<H', min(total, 0xffff)))
+        else:
+            merged.append((chunk_id, data))
+
+    return merged
+
+
+def demodulate(filename, processes = None, base = 1200.0):
+    """uef = demodulate(filename, processes, base)
+
+    Read the tape signals recorded in the WAV file with the specified
+    filename, returning a UEFfile instance containing the carrier tones,
+    data and gaps found. The recording is divided into segments at its
+    carrier tones and the segments are decoded by a pool with the given
+    number of processes.
+    """
+
+    reader = CycleReader(filename, base)
+
+    work = []
+    for start, end in reader.segments():
+        work.append((reader.classes[start:end], reader.lengths[start:end],
+                     reader.sample_rate, reader.base))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(decode_segment, work)
+    finally:
+        pool.close()
+        pool.join()
+
+    chunks = []
+    for result in results:
+        chunks.extend(result)
+
+    uef = UEFfile.UEFfile(creator = 'uefwav.py')
+    uef.chunks = merge_chunks(chunks)
+
+    try:
+        uef.read_contents()
+    except IndexError:
+        # The blocks in the recording could not be read
+        uef.contents = []
+
+    return uef
+
+
+def roundtrip(uef_file, sample_rate = 44100, processes = None):
+    """errors = roundtrip(uef_file, sample_rate, processes)
+
+    Render the UEF file with the specified filename to a temporary WAV file,
+    decode it again and compare the data chunks decoded with the original
+    ones, returning a list of messages describing any differences.
+    """
+
+    uef = UEFfile.UEFfile(uef_file)
+
+    handle, wav_file = tempfile.mkstemp(suffix = '.wav')
+    os.close(handle)
+
+    try:
+        render(uef, wav_file, sample_rate)
+        decoded = demodulate(wav_file, processes)
+    finally:
+        os.remove(wav_file)
+
+    original = map(lambda chunk: str(chunk[1]),
+                   filter(lambda chunk: chunk[0] == 0x100, uef.chunks))
+    found = map(lambda chunk: str(chunk[1]),
+                filter(lambda chunk: chunk[0] == 0x100, decoded.chunks))
+
+    errors = []
+
+    if len(found) != len(original):
+        errors.append('Found %i data chunks instead of %i.' % (len(found), len(original)))
+
+    for i in range(min(len(found), len(original))):
+        if found[i] != original[i]:
+            errors.append('Data chunk %i differs from the original.' % i)
+
+    for file_number, name, block_number, position, header_ok, data_ok in decoded.verify():
+        errors.append('Block %i of file %i (%s) has a bad CRC.' % (
+                      block_number, file_number, name))
+
+    if len(decoded.contents) != len(uef.contents):
+        errors.append('Found %i files instead of %i.' % (len(decoded.contents),
+                                                         len(uef.contents)))
+    return errors
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    options = {"-r": 44100, "-j": None}
+
+    for option in options.keys():
+        if option in args:
+            i = args.index(option)
+            try:
+                options[option] = int(args[i + 1])
+                del args[i:i + 2]
+            except (IndexError, ValueError):
+                args = []
+
+    command = None
+    for option in ("-d", "-c"):
+        if option in args:
+            args.remove(option)
+            command = option
+
+    if (command == "-c" and len(args) != 1) or (command != "-c" and len(args) != 2):
+
+        sys.stderr.write("Usage: %s [-r <sample rate>] <UEF file> <WAV file>\n"
+                         "       %s -d [-j <processes>] <WAV file> <new UEF file>\n"
+                         "       %s -c [-r <sample rate>] [-j <processes>] <UEF file>\n" % (
+                         sys.argv[0], sys.argv[0], sys.argv[0]))
+        sys.exit(1)
+
+    try:
+        if command == "-c":
+
+            # Check that the file can be rendered and decoded again
+            errors = roundtrip(args[0], options["-r"], options["-j"])
+            for error in errors:
+                print error
+
+            if errors:
+                sys.exit(1)
+
+            print "Decoded", args[0], "correctly"
+
+        elif command == "-d":
+
+            wav_file, uef_file = args
+            demodulate(wav_file, options["-j"]).write(uef_file)
+
+        else:
+            uef_file, wav_file = args
+
+            uef = UEFfile.UEFfile(uef_file, lazy = True)
+            try:
+                render(uef, wav_file, options["-r"])
+            finally:
+                uef.close()
+
+    except UEFfile.UEFfile_error, exception:
+        sys.stderr.write("%s\n" % exception)
+        sys.exit(1)
+
+    # Exit
+    sys.exit()